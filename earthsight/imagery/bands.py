@@ -34,6 +34,17 @@ class Bands:
         return this_band
 
 
+    def copy(self):
+        '''
+        get an independent copy of all bands and their current ranges
+        '''
+        bands = Bands()
+        for band in self.bands:
+            bands.bands.append(band.copy())
+
+        return bands
+
+
 class Band:
     def __init__(self, name, min_val, max_val):
         '''
@@ -55,6 +66,16 @@ class Band:
         self.hi_val = hi_val
 
 
+    def copy(self):
+        '''
+        get an independent copy of this band with its current range
+        '''
+        band = Band(self.name, self.min_val, self.max_val)
+        band.set_range(self.lo_val, self.hi_val)
+
+        return band
+
+
     # ------------- #
     # -- GETTERS -- #
     # ------------- #
@@ -0,0 +1,108 @@
+'''
+cost.py
+
+Class definitions for CostEstimate and CostBudget, which judge how expensive a composite is before it is
+requested, so requests that would time out can be warned about, downgraded or refused
+'''
+
+
+from earthsight.utils.tiles import bounds_to_meters
+
+
+# define what happens to requests over budget, 'warn' goes ahead anyway, 'downgrade' requests less,
+# 'refuse' raises BudgetExceeded
+COST_POLICY = 'downgrade'
+
+# define the most scenes a composite may combine
+COST_MAX_SCENES = 400
+
+# define the most scene pixels, i.e. scenes times output pixels, a composite may read
+COST_MAX_PIXELS = 1.5e8
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class CostEstimate:
+    def __init__(self, scenes, pixels, scale):
+        '''
+        container for the expected size of a composite at a scale in meters, with the budget
+        decision taken on it and any changes made to stay within budget
+        '''
+        self.scenes = scenes
+        self.pixels = pixels
+        self.scale = scale
+
+        self.decision = 'ok'
+        self.notes = list()
+
+
+    def get_cost(self):
+        '''
+        get the number of scene pixels read, the unit budgets are set in
+        '''
+        return self.scenes * self.pixels
+
+
+    def describe(self):
+        '''
+        get a short summary of the estimate and decision, for display
+        '''
+        summary = '{} scenes over {:,} px at {} m, {}'.format(
+            self.scenes,
+            self.pixels,
+            self.scale,
+            self.decision
+        )
+        if self.notes:
+            summary += ': ' + ', '.join(self.notes)
+
+        return summary
+
+
+class CostBudget:
+    def __init__(self, policy=COST_POLICY, max_scenes=COST_MAX_SCENES, max_pixels=COST_MAX_PIXELS):
+        '''
+        container for limits on composite size and the policy applied when they are exceeded
+        '''
+        if policy not in ['warn', 'downgrade', 'refuse']:
+            raise ValueError('unknown budget policy {}'.format(policy))
+
+        self.policy = policy
+        self.max_scenes = max_scenes
+        self.max_pixels = max_pixels
+
+
+    def get_max_scenes(self, pixels):
+        '''
+        get the most scenes that fit the budget at a given output size
+        '''
+        return min(self.max_scenes, int(self.max_pixels // max(pixels, 1)))
+
+
+    def check(self, estimate):
+        '''
+        decide on an estimate, 'ok' within budget and the policy otherwise, raises BudgetExceeded
+        when the policy is to refuse
+        '''
+        if estimate.scenes <= self.get_max_scenes(estimate.pixels):
+            estimate.decision = 'ok'
+        else:
+            estimate.decision = self.policy
+
+        if estimate.decision == 'refuse':
+            raise BudgetExceeded(
+                '{}, narrow the date range or zoom in'.format(estimate.describe())
+            )
+
+        return estimate.decision
+
+
+def estimate_pixels(bounds, scale):
+    '''
+    get the number of output pixels covering leaflet bounds at a scale in meters
+    '''
+    min_x, min_y, max_x, max_y = bounds_to_meters(bounds)
+
+    return int(abs(max_x - min_x) / scale * abs(max_y - min_y) / scale)
@@ -28,6 +28,22 @@ class ImgParams:
         self.temporal_op = temporal_op
 
 
+    def copy(self):
+        '''
+        get an independent copy of these image parameters
+        '''
+        img_params = ImgParams()
+        img_params.set(
+            self.start_datetime,
+            self.end_datetime,
+            self.cloudy_pixel_pct,
+            self.cloud_mask,
+            self.temporal_op
+        )
+
+        return img_params
+
+
     # ------------- #
     # -- GETTERS -- #
     def get_start_datetime(self):
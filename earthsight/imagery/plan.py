@@ -0,0 +1,140 @@
+'''
+plan.py
+
+Class definition for QueryPlan, which builds image collections with filters pushed down to the source collections
+'''
+
+
+import ee
+
+
+class QueryPlan:
+    def __init__(self, collection_id):
+        '''
+        container that describes how to build an image collection before anything is issued to GEE
+        '''
+        self.collection_id = collection_id
+
+        self.start_datetime = None
+        self.end_datetime = None
+        self.bounds = None
+        self.metadata_filters = list()
+
+        self.join_id = None
+        self.join_name = None
+
+
+    def filter_date(self, start_datetime, end_datetime):
+        '''
+        restrict primary and joined collections to a date range
+        '''
+        self.start_datetime = start_datetime
+        self.end_datetime = end_datetime
+
+
+    def filter_bounds(self, bounds):
+        '''
+        restrict primary and joined collections to scenes intersecting an ee.Geometry
+        '''
+        self.bounds = bounds
+
+
+    def filter_metadata(self, name, op, value):
+        '''
+        restrict primary collection by a metadata property, op is an ee.Filter comparison such as lte
+        '''
+        self.metadata_filters.append((name, op, value))
+
+
+    def join(self, join_id, join_name):
+        '''
+        join a secondary collection by system:index, adding its bands to the primary collection
+        '''
+        self.join_id = join_id
+        self.join_name = join_name
+
+
+    def _get_filters(self, metadata):
+        '''
+        get filters applied to a source collection, metadata filters only apply to the primary collection
+        '''
+        filters = list()
+        if self.start_datetime is not None:
+            filters.append(ee.Filter.date(self.start_datetime, self.end_datetime))
+
+        if self.bounds is not None:
+            filters.append(ee.Filter.bounds(self.bounds))
+
+        if metadata:
+            for name, op, value in self.metadata_filters:
+                filters.append(getattr(ee.Filter, op)(name, value))
+
+        return filters
+
+
+    def _filter(self, collection_id, metadata):
+        '''
+        get a source collection with its filters applied
+        '''
+        ic = ee.ImageCollection(collection_id)
+        for filt in self._get_filters(metadata):
+            ic = ic.filter(filt)
+
+        return ic
+
+
+    def build(self):
+        '''
+        build image collection, filtering each source before the join so the join only sees matching scenes
+        '''
+        primary = self._filter(self.collection_id, metadata=True)
+        if self.join_id is None:
+            return primary
+
+        secondary = self._filter(self.join_id, metadata=False)
+        joined = ee.Join.saveFirst(self.join_name).apply(
+            primary=primary,
+            secondary=secondary,
+            condition=ee.Filter.equals(
+                leftField='system:index',
+                rightField='system:index'
+            )
+        )
+
+        join_name = self.join_name
+        ic = ee.ImageCollection(joined).map(
+            lambda img: img.addBands(
+                img.get(join_name)
+            )
+        )
+
+        return ic
+
+
+    def describe(self):
+        '''
+        describe the plan as it will be issued to GEE
+        '''
+        filters = list()
+        if self.start_datetime is not None:
+            filters.append('date [{}, {})'.format(self.start_datetime, self.end_datetime))
+
+        if self.bounds is not None:
+            filters.append('bounds')
+
+        metadata = ['{} {} {}'.format(name, op, value) for name, op, value in self.metadata_filters]
+
+        lines = ['scan {}'.format(self.collection_id)]
+        lines += ['  filter {}'.format(f) for f in filters + metadata]
+        if self.join_id is None:
+            lines.append('skip join')
+        else:
+            lines.append('scan {}'.format(self.join_id))
+            lines += ['  filter {}'.format(f) for f in filters]
+            lines.append('join on system:index as {}, add bands'.format(self.join_name))
+
+        return '\n'.join(lines)
+
+
+    def __str__(self):
+        return self.describe()
@@ -0,0 +1,238 @@
+'''
+raster.py
+
+LocalRaster class definition that provides methods for accessing local GeoTIFF/COG imagery via GDAL
+'''
+
+
+from datetime import datetime
+import os
+import threading
+
+import numpy as np
+from osgeo import gdal
+
+from earthsight.imagery.bands import Bands
+from earthsight.imagery.imgparams import ImgParams
+from earthsight.imagery.source import ImagerySource
+from earthsight.utils.constants import ZOOM_TO_SCALE
+from earthsight.utils.tiles import (TILE_SIZE,
+                                    bounds_to_meters,
+                                    tile_to_meters)
+from earthsight.utils.tileserver import TILE_SERVER
+
+
+gdal.UseExceptions()
+
+# define number of fixed histogram bins between a band's min and max
+LOCAL_HIST_BINS = 256
+
+# define largest side in pixels read to compute a histogram
+LOCAL_HIST_MAX_SIZE = 1024
+
+
+class LocalRaster(ImagerySource):
+    def __init__(self, path, band_presets=None):
+        '''
+        container for accessing a local GeoTIFF or COG, reading only the blocks and overviews needed
+        '''
+        self.path = path
+
+        # GDAL datasets cannot be shared across threads
+        self.local = threading.local()
+
+        ds = self._open()
+        bands, default_presets = self._read_bands(ds)
+        if band_presets is None:
+            band_presets = default_presets
+
+        super().__init__(bands, band_presets, self._read_img_params(ds))
+
+
+    def _open(self):
+        '''
+        get the dataset for the current thread
+        '''
+        ds = getattr(self.local, 'ds', None)
+        if ds is None:
+            ds = gdal.Open(self.path)
+            self.local.ds = ds
+
+        return ds
+
+
+    def _read_bands(self, ds):
+        '''
+        read band names and value ranges, and build presets stretched to mean +/- 2 std, raises
+        ValueError for non-integer bands
+        '''
+        bands = Bands()
+        self.band_idxs = dict()
+
+        band_presets = dict()
+        names = list()
+        los = list()
+        his = list()
+        for idx in range(1, ds.RasterCount + 1):
+            rb = ds.GetRasterBand(idx)
+            name = rb.GetDescription() or 'b{}'.format(idx)
+
+            # band sliders step through integers, float ranges such as 0-1 reflectance would collapse
+            type_name = gdal.GetDataTypeName(rb.DataType)
+            if type_name != 'Byte' and not type_name.startswith(('Int', 'UInt')):
+                raise ValueError(
+                    'band {} of {} is {}, only integer bands are supported'.format(name, self.path, type_name)
+                )
+
+            # approximate statistics are computed from overviews when the file has them
+            min_val, max_val, mean, std = rb.GetStatistics(True, True)
+            min_val = int(np.floor(min_val))
+            max_val = int(np.ceil(max_val))
+            lo = int(max(min_val, mean - 2 * std))
+            hi = int(min(max_val, mean + 2 * std))
+
+            bands.add(name, min_val, max_val)
+            self.band_idxs[name] = idx
+
+            band_presets[name] = ([name], [lo], [hi])
+            names.append(name)
+            los.append(lo)
+            his.append(hi)
+
+        # show the first three bands as a color composite by default
+        if len(names) >= 3:
+            band_presets = dict(
+                [('color', (names[:3], los[:3], his[:3]))] + list(band_presets.items())
+            )
+
+        return bands, band_presets
+
+
+    def _read_img_params(self, ds):
+        '''
+        read acquisition date from the file, falling back to its modification date
+        '''
+        stamp = ds.GetMetadataItem('TIFFTAG_DATETIME')
+        if stamp:
+            date = datetime.strptime(stamp[:10], '%Y:%m:%d')
+        else:
+            date = datetime.fromtimestamp(os.path.getmtime(self.path))
+        date = date.strftime('%Y-%m-%d')
+
+        img_params = ImgParams()
+        img_params.set(
+            start_datetime=date,
+            end_datetime=date,
+            cloudy_pixel_pct=100,
+            cloud_mask=False,
+            temporal_op='mosaic'
+        )
+
+        return img_params
+
+
+    def read_region(self, bounds, width, height, band_names):
+        '''
+        read bands over web mercator bounds into arrays of a given size, returns data in the file's
+        data type and a valid mask
+        '''
+        ds = self._open()
+        band_list = [self.band_idxs[name] for name in band_names]
+
+        # the warper only reads the blocks that intersect the bounds, from the best overview level
+        vrt = gdal.Translate('', ds, format='VRT', bandList=band_list)
+        warped = gdal.Warp(
+            '',
+            vrt,
+            format='MEM',
+            dstSRS='EPSG:3857',
+            outputBounds=bounds,
+            width=width,
+            height=height,
+            resampleAlg='near',
+            dstAlpha=True
+        )
+
+        arr = warped.ReadAsArray()
+        data = arr[:-1]
+        valid = arr[-1] > 0
+
+        return data, valid
+
+
+    def update_ic(self):
+        '''
+        a single file has no collection to build
+        '''
+        pass
+
+
+    def update_img(self):
+        '''
+        a single file has no temporal operation to apply
+        '''
+        pass
+
+
+    def compute_hist(self, bounds, zoom):
+        '''
+        compute histogram over given map bounds for selected bands, at the scale of a zoom level
+        '''
+        bounds = bounds_to_meters(bounds)
+        scale = ZOOM_TO_SCALE[int(round(zoom))]
+
+        width = max(int((bounds[2] - bounds[0]) / scale), 1)
+        height = max(int((bounds[3] - bounds[1]) / scale), 1)
+        shrink = max(width / LOCAL_HIST_MAX_SIZE, height / LOCAL_HIST_MAX_SIZE, 1)
+        width = max(int(width / shrink), 1)
+        height = max(int(height / shrink), 1)
+
+        data, valid = self.read_region(bounds, width, height, self.active_bands)
+
+        hist_dict = dict()
+        for band_data, band_name in zip(data, self.active_bands):
+            band = self.bands.get(band_name)
+            counts, edges = np.histogram(
+                band_data[valid],
+                bins=LOCAL_HIST_BINS,
+                range=(band.get_min(), band.get_max())
+            )
+            bucket_means = (edges[:-1] + edges[1:]) / 2
+            hist_dict[band_name] = (bucket_means.tolist(), counts.tolist())
+
+        return hist_dict
+
+
+    def request_hist(self, bounds, zoom, batch):
+        '''
+        histograms are computed locally, so nothing is added to the batch
+        '''
+        return lambda: self.compute_hist(bounds, zoom)
+
+
+    def read_tile(self, z, x, y, band_names):
+        '''
+        read raw bands of a web mercator tile, the tile server applies the stretch
+        '''
+        return self.read_region(tile_to_meters(x, y, z), TILE_SIZE, TILE_SIZE, band_names)
+
+
+    def get_url(self):
+        '''
+        get tile layer URL served by the local tile server
+        '''
+        return TILE_SERVER.register(self)
+
+
+    def clone(self):
+        '''
+        get a new source for the same file
+        '''
+        return LocalRaster(self.path, band_presets=self.band_presets)
+
+
+    # ------------- #
+    # -- GETTERS -- #
+    # ------------- #
+    def get_name(self):
+        return os.path.basename(self.path)
@@ -0,0 +1,75 @@
+'''
+rawtiles.py
+
+Python utilities for fetching raw, unstretched GEE band values as tiles, so stretches can be applied locally
+'''
+
+
+import io
+
+import ee
+import numpy as np
+from PIL import Image
+
+from earthsight.utils.cache import LRUCache
+from earthsight.utils.gee import (graph_hash,
+                                  image_to_tiles)
+from earthsight.utils.tilecache import TILE_CACHE
+from earthsight.utils.tiles import TILE_SIZE
+
+
+# number of raw single-band tiles kept in memory, each is about 330 KB
+RAW_TILE_CACHE_SIZE = 512
+
+# raw band tiles keyed by image graph hash, band and z/x/y
+RAW_TILE_CACHE = LRUCache(RAW_TILE_CACHE_SIZE)
+
+# packed bands are visualized byte for byte, as lossless PNG
+PACKED_VIZ_PARAMS = {
+    'bands': ['hi', 'lo', 'pad'],
+    'min': [0, 0, 0],
+    'max': [255, 255, 255],
+    'format': 'png'
+}
+
+
+def pack_band(img, band_name, min_val):
+    '''
+    get an image that stores a band as 16 bit offsets from min_val, high byte as red and low byte as green
+    '''
+    value = img.select(band_name).subtract(min_val).round().clamp(0, 65535).toUint16()
+
+    hi = value.rightShift(8).rename('hi')
+    lo = value.bitwiseAnd(255).rename('lo')
+
+    # blue is unused, it repeats the high byte so it shares the band mask
+    pad = hi.rename('pad')
+
+    return ee.Image.cat([hi, lo, pad])
+
+
+def get_raw_tile(img, img_hash, band_name, min_val, z, x, y):
+    '''
+    get raw band values and a valid mask for a tile, fetching it only if it is not cached in memory or on disk
+    '''
+    key = (img_hash, band_name, z, x, y)
+    raw = RAW_TILE_CACHE.get(key)
+    if raw is None:
+        # the map ID only depends on the image and band, never on the stretch
+        packed = pack_band(img, band_name, min_val)
+        url = image_to_tiles(packed, PACKED_VIZ_PARAMS)
+        png = TILE_CACHE.fetch(graph_hash(packed, PACKED_VIZ_PARAMS), url, z, x, y)
+
+        if png is None:
+            # no tile upstream, nothing in it is valid
+            value = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.int32)
+            valid = np.zeros((TILE_SIZE, TILE_SIZE), dtype=bool)
+        else:
+            rgba = np.array(Image.open(io.BytesIO(png)).convert('RGBA'))
+            value = rgba[..., 0].astype(np.int32) * 256 + rgba[..., 1] + min_val
+            valid = rgba[..., 3] > 0
+
+        raw = (value, valid)
+        RAW_TILE_CACHE.set(key, raw)
+
+    return raw
@@ -6,12 +6,31 @@ Sentinel-2 class definition that provides methods for accessing imagery via GEE
 
 
 import ee
-ee.Initialize()
+import json
 
 from earthsight.imagery.bands import Bands
+from earthsight.imagery.cost import (CostBudget,
+                                     CostEstimate,
+                                     estimate_pixels)
 from earthsight.imagery.imgparams import ImgParams
+from earthsight.imagery.plan import QueryPlan
+from earthsight.imagery.source import ImagerySource
+from earthsight.utils.cache import LRUCache
+from earthsight.utils.constants import ZOOM_TO_SCALE
+from earthsight.utils.dates import split_months
 from earthsight.utils.gee import (image_to_tiles,
-                                  bounds_to_geom)
+                                  Batch,
+                                  bounds_to_geom,
+                                  contains_bounds,
+                                  graph_hash,
+                                  initialize,
+                                  pad_bounds)
+from earthsight.utils.tiles import (bounds_to_pixels,
+                                    quadkey_to_tile,
+                                    tile_to_bounds,
+                                    tile_to_quadkey,
+                                    tiles_in_bounds)
+from earthsight.utils.tileserver import TILE_SERVER
 
 
 # define default S2 collection IDs, including imagery and cloud mask
@@ -21,6 +40,73 @@ S2_COLLECTION_IDS = ['COPERNICUS/S2',
 # define default max cloud probability threshold
 S2_MAX_CLOUD_PROBABILITY = 65
 
+# define band added by joining the cloud probability collection
+S2_CLOUD_BAND = 'probability'
+
+# define number of fixed histogram bins between a band's min and max, so cell histograms can be merged
+S2_HIST_BINS = 256
+
+# define how many zoom levels coarser than the map the histogram grid is, each cell is 4x4 map tiles
+S2_HIST_GRID_OFFSET = 2
+
+# define how many pixels a histogram reads over the whole view, its scale follows from the view's area
+S2_HIST_PIXEL_BUDGET = 1e6
+
+# define how far past the pixel budget a single cell may go before GEE refuses it, a safety margin for
+# pixels along cell edges
+S2_HIST_MAX_PIXELS_FACTOR = 4
+
+# define how many random pixels are drawn per grid cell when sampling, a view usually spans a handful
+# of cells, fixed so cached cells stay valid as the view changes
+S2_HIST_CELL_SAMPLES = int(S2_HIST_PIXEL_BUDGET / 8)
+
+# define how histograms read pixels, 'reduce' reduces every pixel at the budget's scale, 'sample'
+# draws the budget's number of random pixels at the map's scale, 'auto' samples only views too large
+# to reduce at the map's scale
+S2_HIST_MODE = 'reduce'
+
+# histogram counts per grid cell, shared by all instances since keys include the image graph
+S2_HIST_CELL_CACHE = LRUCache(4096)
+
+# built collections and composites shared by all instances, keyed by the parameters they depend on,
+# ee objects are immutable so a new layer with the same settings reuses them as they are
+S2_IC_CACHE = LRUCache(64)
+S2_IMG_CACHE = LRUCache(64)
+
+# define how composites are built, 'full' reduces the whole window at once, 'monthly' combines
+# per-month partial aggregates so sliding or widening the date window reuses the unchanged months'
+# graphs, see set_composite_mode for its limits
+S2_COMPOSITE_MODE = 'full'
+
+# define temporal operations that can be combined from partial aggregates, others use the full window
+S2_MERGEABLE_OPS = ['mean', 'min', 'max']
+
+# per-month partial aggregates shared by all instances, identical graphs let GEE reuse its own caches too
+S2_PARTIAL_CACHE = LRUCache(512)
+
+# define where tiles are stretched, 'server' renders on GEE, 'local' fetches raw values once and
+# stretches them in the local tile server so stretch changes need no network traffic
+S2_RENDER_MODE = 'server'
+
+# define how many of the least cloudy scenes are mosaicked into a preview while a composite renders
+S2_PREVIEW_SCENES = 3
+
+# images within the cost budget with their estimates, keyed by the parameters and the zoom level
+# they were estimated for
+S2_BUDGET_CACHE = LRUCache(256)
+
+# scene counts of built collections, keyed by the collection and the bounds counted over, None for all
+S2_SCENE_CACHE = LRUCache(1024)
+
+# define the fewest scenes worth compositing, a downgrade to fewer scenes shows a mosaic instead
+S2_MIN_COMPOSITE_SCENES = 3
+
+# define how many zoom levels coarser than the map a downgraded histogram may reduce at
+S2_HIST_MAX_COARSEN = 2
+
+# define how far the cached viewport envelope extends past the map bounds, as a fraction of their size
+S2_VIEWPORT_PAD = 0.5
+
 # define default bands to access, including combined cloud mask probability band
 S2_BAND_DEFS = {
     'B1': (0, 10000),
@@ -82,7 +168,7 @@ S2_IMG_PARAMS.set(
 )
 
 
-class Sentinel2:
+class Sentinel2(ImagerySource):
     def __init__(self,
                  collection_ids=S2_COLLECTION_IDS,
                  bands=S2_BANDS,
@@ -92,50 +178,96 @@ class Sentinel2:
         container for accessing S2 imagery via GEE
         '''
         self.collection_ids = collection_ids
-        self.bands = bands
-        self.band_presets = band_presets
-        self.img_params = img_params
 
+        self.plan = None
         self.ic = None
         self.img = None
-        self.active_bands = list()
-        self.viz_params = None
 
-        # initialize image collection
-        self.update_ic()
+        # keys the collection and composite were built for, parameters may change before the next update
+        self.ic_key = None
+        self.img_key = None
+
+        # padded viewport scenes are restricted to
+        self.envelope = None
+
+        # map bounds and zoom level that rendering costs are estimated for
+        self.viewport = None
 
-        # initialize visualization with true color preset
-        band_names, band_los, band_his = self.band_presets['true color']
-        self.set_active_bands(band_names, band_los, band_his)
-        self.update_viz()
+        self.budget = CostBudget()
+        self.estimate = None
+        self.hist_estimate = None
 
+        self.hist_mode = S2_HIST_MODE
+        self.hist_stats = None
 
-    def _build_ic(self):
+        self.composite_mode = S2_COMPOSITE_MODE
+
+        # initialize with true color preset, which is the first preset
+        super().__init__(bands, band_presets, img_params)
+
+        # S2 tiles can be stretched on GEE or locally
+        self.render_mode = S2_RENDER_MODE
+
+
+    def _plan_ic(self, start_datetime=None, end_datetime=None):
         '''
-        build image collection that combines imagery and cloud probability collections
+        plan image collection, pushing filters down to the imagery and cloud probability collections,
+        dates default to the image parameters
         '''
-        # define S2 and S2 cloud probability image collections
-        s2 = ee.ImageCollection(self.collection_ids[0])
-        s2cloud = ee.ImageCollection(self.collection_ids[1])
+        plan = QueryPlan(self.collection_ids[0])
+        self._filter_date(plan, start_datetime, end_datetime)
+        self._filter_bounds(plan)
+        self._filter_clouds(plan)
 
-        # join collections
-        s2joined = ee.Join.saveFirst('cloud_mask').apply(
-            primary=s2,
-            secondary=s2cloud,
-            condition=ee.Filter.equals(
-                leftField='system:index',
-                rightField='system:index'
-            )
-        )
+        # cloud probability is only needed to mask clouds or to show the probability band
+        if self._needs_clouds():
+            plan.join(self.collection_ids[1], 'cloud_mask')
+
+        return plan
 
-        # add probability band into the original S2 image collection
-        s2combined = ee.ImageCollection(s2joined).map(
-            lambda img: img.addBands(
-                img.get('cloud_mask')
-            )
+
+    def _needs_clouds(self):
+        '''
+        check if the cloud probability collection has to be joined
+        '''
+        return bool(self.img_params.get_cloud_mask()) or S2_CLOUD_BAND in self.active_bands
+
+
+    def _get_ic_key(self):
+        '''
+        get the parameters that the image collection stage depends on
+        '''
+        ic_key = (
+            self.img_params.get_start_datetime(),
+            self.img_params.get_end_datetime(),
+            self.img_params.get_cloudy_pixel_pct(),
+            self.img_params.get_cloud_mask(),
+            self._needs_clouds(),
+            self.envelope,
+            json.dumps(self.aoi, sort_keys=True)
         )
 
-        return s2combined
+        return ic_key
+
+
+    def _get_img_key(self):
+        '''
+        get the parameters that the image stage depends on
+        '''
+        return (self.img_params.get_temporal_op(), self.composite_mode)
+
+
+    def _get_stage_keys(self):
+        '''
+        get the parameters that each processing stage depends on, tile URLs also depend on render mode
+        '''
+        stage_keys = super()._get_stage_keys()
+
+        # the budget is judged per zoom level, so a new zoom level prices the composite again
+        zoom = None if self.viewport is None else self.viewport[1]
+        stage_keys['viz'] += (self.render_mode, self._get_budget_key(zoom)[2:])
+
+        return stage_keys
 
 
     def _ic_to_image(self):
@@ -143,52 +275,134 @@ class Sentinel2:
         convert an image collection to an image via some temporal operation
         '''
         temporal_op = self.img_params.get_temporal_op()
+        if self.composite_mode == 'monthly' and temporal_op in S2_MERGEABLE_OPS:
+            self.img = self._merge_partials(temporal_op)
+        else:
+            self.img = self._reduce_ic(self.ic, temporal_op)
+
+
+    def _reduce_ic(self, ic, temporal_op):
+        '''
+        apply a temporal operation to a whole image collection at once
+        '''
         if temporal_op == 'mean':
-            self.img = self.ic.mean()
-        elif temporal_op == 'min':
-            self.img = self.ic.min()
-        elif temporal_op == 'max':
-            self.img = self.ic.max()
-        elif temporal_op == 'median':
-            self.img = self.ic.median()
-        elif temporal_op == 'mosaic':
-            self.img = self.ic.mosaic()
+            return ic.mean()
+        if temporal_op == 'min':
+            return ic.min()
+        if temporal_op == 'max':
+            return ic.max()
+        if temporal_op == 'median':
+            return ic.median()
+        if temporal_op == 'mosaic':
+            return ic.mosaic()
 
     
-    def _filter_date(self):
+    def _merge_partials(self, temporal_op):
         '''
-        filter image collection by start and end date
+        combine per-month partial aggregates into a composite over the whole date window
         '''
-        start_datetime = self.img_params.get_start_datetime()
-        end_datetime = self.img_params.get_end_datetime()
+        partials = list()
+        for start_datetime, end_datetime in split_months(
+            self.img_params.get_start_datetime(),
+            self.img_params.get_end_datetime()
+        ):
+            partials.append(self._get_partial(start_datetime, end_datetime, temporal_op))
 
-        self.ic = self.ic.filterDate(start_datetime, end_datetime)
+        merged = ee.ImageCollection.fromImages(partials).filter(ee.Filter.gt('scenes', 0))
+        if temporal_op == 'min':
+            return merged.min()
+        if temporal_op == 'max':
+            return merged.max()
+
+        # a mean is the sum of all monthly sums over the sum of all monthly counts
+        totals = merged.sum()
+        sums = totals.select('.*_sum')
+        counts = totals.select('.*_count')
+        names = sums.bandNames().map(lambda name: ee.String(name).replace('_sum$', ''))
+
+        return sums.divide(counts).rename(names)
+
+
+    def _get_partial(self, start_datetime, end_datetime, temporal_op):
+        '''
+        get the partial aggregate of one month, built only if no instance has built it yet
+        '''
+        # everything the collection depends on except the window's dates
+        key = (
+            tuple(self.collection_ids),
+            start_datetime,
+            end_datetime,
+            self._get_ic_key()[2:],
+            temporal_op
+        )
+
+        partial = S2_PARTIAL_CACHE.get(key)
+        if partial is None:
+            plan = self._plan_ic(start_datetime, end_datetime)
+            ic = self._mask_clouds(plan.build())
+
+            if temporal_op == 'min':
+                partial = ic.min()
+            elif temporal_op == 'max':
+                partial = ic.max()
+            else:
+                reducer = ee.Reducer.sum().combine(ee.Reducer.count(), sharedInputs=True)
+                partial = ic.reduce(reducer)
+
+            # months without scenes have no bands, they are dropped before merging
+            partial = partial.set('scenes', ic.size())
+
+            S2_PARTIAL_CACHE.set(key, partial)
+
+        return partial
+
+
+    def _filter_date(self, plan, start_datetime=None, end_datetime=None):
+        '''
+        filter image collection by start and end date, defaulting to the image parameters
+        '''
+        if start_datetime is None:
+            start_datetime = self.img_params.get_start_datetime()
+            end_datetime = self.img_params.get_end_datetime()
+
+        plan.filter_date(start_datetime, end_datetime)
+
+
+    def _filter_bounds(self, plan):
+        '''
+        filter image collection to scenes intersecting the area of interest, or else the viewport
+        '''
+        if self.aoi is not None:
+            plan.filter_bounds(ee.Geometry(self.aoi))
+        elif self.envelope is not None:
+            plan.filter_bounds(bounds_to_geom(self.envelope))
 
     
-    def _filter_clouds(self):
+    def _filter_clouds(self, plan):
         '''
         filter an image collection by cloudy pixel metadata
         '''
         cloudy_pixel_pct = self.img_params.get_cloudy_pixel_pct()
-        cloud_filt = ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', cloudy_pixel_pct)
-        self.ic = self.ic.filter(cloud_filt)
+        plan.filter_metadata('CLOUDY_PIXEL_PERCENTAGE', 'lte', cloudy_pixel_pct)
 
 
-    def _mask_clouds(self):
+    def _mask_clouds(self, ic):
         '''
         mask clouds in image collection 
         '''
         mask_clouds = self.img_params.get_cloud_mask()
         if mask_clouds:
-            self.ic = self.ic.map(self.__edge_mask)
-            self.ic = self.ic.map(self.__cloud_mask)
+            ic = ic.map(self.__edge_mask)
+            ic = ic.map(self.__cloud_mask)
+
+        return ic
 
 
     def __cloud_mask(self, img):
         '''
         function called by map() to mask clouds using s2cloudless
         '''
-        clouds = ee.Image(img.get('cloud_mask')).select('probability')
+        clouds = ee.Image(img.get('cloud_mask')).select(S2_CLOUD_BAND)
         clouds_mask = clouds.lt(S2_MAX_CLOUD_PROBABILITY)
         
         return img.updateMask(clouds_mask)
@@ -205,97 +419,545 @@ class Sentinel2:
         return img.updateMask(edge_mask)
 
 
-    def compute_hist(self, bounds, scale):
+    def estimate_cost(self, bounds, zoom):
+        '''
+        estimate the cost of the composite over map bounds at the scale of a zoom level, scenes are
+        counted in a single metadata query and pixels follow from the bounds
+        '''
+        scale = ZOOM_TO_SCALE[zoom]
+
+        return CostEstimate(self._count_scenes(bounds), estimate_pixels(bounds, scale), scale)
+
+
+    def _count_scenes(self, bounds):
+        '''
+        count the scenes of the collection intersecting map bounds, or all of its scenes for None, the
+        collection itself covers the padded envelope
+        '''
+        key = self._get_count_key(bounds)
+        scenes = S2_SCENE_CACHE.get(key)
+        if scenes is None:
+            batch = Batch()
+            finish = self._request_scenes(bounds, batch)
+            batch.evaluate()
+            finish()
+
+            scenes = S2_SCENE_CACHE.get(key)
+
+        return scenes
+
+
+    def _get_count_key(self, bounds):
         '''
-        compute histogram over given map bounds and at a defined scale for selected bands
+        get the key scene counts over map bounds are cached under
         '''
-        roi = bounds_to_geom(bounds)
-        hist_img = self.img.select(self.active_bands)
-        hist = hist_img.reduceRegion(
-            reducer=ee.Reducer.histogram(),
-            geometry=roi,
+        # leaflet reports bounds as lists
+        if bounds is not None:
+            bounds = tuple(tuple(corner) for corner in bounds)
+
+        return (self.ic_key, bounds)
+
+
+    def _request_scenes(self, bounds, batch):
+        '''
+        add the scene counts a budget decision over map bounds needs to a batch, both within the bounds
+        and over the whole collection for downgrades, returns a function that caches them once the
+        batch is evaluated
+        '''
+        missing = dict()
+        for count_bounds in [bounds, None]:
+            key = self._get_count_key(count_bounds)
+            if S2_SCENE_CACHE.get(key) is None:
+                ic = self.ic
+                if count_bounds is not None:
+                    ic = ic.filterBounds(bounds_to_geom(count_bounds))
+                missing[key] = batch.add(ic.size())
+
+        def finish():
+            for key, batch_key in missing.items():
+                S2_SCENE_CACHE.set(key, batch.get(batch_key))
+
+        return finish
+
+
+    def _get_budget_key(self, zoom):
+        '''
+        get the parameters a budget decision at a zoom level depends on, for the composite as built
+        '''
+        budget_key = (
+            self.ic_key,
+            self.img_key,
+            zoom,
+            (self.budget.policy, self.budget.max_scenes, self.budget.max_pixels)
+        )
+
+        return budget_key
+
+
+    def _get_budget_img(self, bounds, zoom):
+        '''
+        get the composite to request over map bounds at a zoom level's scale, downgraded if it is
+        over budget and the policy allows, with the estimate it was judged on
+        '''
+        key = self._get_budget_key(zoom)
+        budgeted = S2_BUDGET_CACHE.get(key)
+        if budgeted is None:
+            estimate = self.estimate_cost(bounds, zoom)
+
+            img = self.img
+            if self.budget.check(estimate) == 'downgrade':
+                img = self._downgrade(estimate)
+
+            budgeted = (img, estimate)
+            S2_BUDGET_CACHE.set(key, budgeted)
+
+        return budgeted
+
+
+    def _downgrade(self, estimate):
+        '''
+        get a cheaper composite from only as many of the least cloudy scenes as the budget allows,
+        falling back to a mosaic when too few remain to composite
+        '''
+        max_scenes = max(self.budget.get_max_scenes(estimate.pixels), 1)
+
+        # the collection covers the padded envelope, so it keeps as many scenes per area as the view may use
+        limit = max(int(max_scenes * self._count_scenes(None) / max(estimate.scenes, 1)), 1)
+        ic = self.ic.sort('CLOUDY_PIXEL_PERCENTAGE').limit(limit)
+        estimate.notes.append('using the {} least cloudy scenes'.format(max_scenes))
+
+        temporal_op = self.img_params.get_temporal_op()
+        if max_scenes < S2_MIN_COMPOSITE_SCENES and temporal_op != 'mosaic':
+            estimate.notes.append('mosaic instead of {}'.format(temporal_op))
+            temporal_op = 'mosaic'
+
+        # sorted so that a mosaic puts the least cloudy scene on top
+        img = self._reduce_ic(ic.sort('CLOUDY_PIXEL_PERCENTAGE', False), temporal_op)
+        if self.aoi is not None:
+            img = img.clip(ee.Geometry(self.aoi))
+
+        return img
+
+
+    def _get_render_img(self):
+        '''
+        get the composite to render for the current viewport, within the cost budget
+        '''
+        # there is nothing to price without a viewport, Layers sets one before the first build
+        if self.viewport is None:
+            return self.img
+
+        bounds, zoom = self.viewport
+        img, self.estimate = self._get_budget_img(bounds, zoom)
+
+        return img
+
+
+    def _get_hist_img(self, bounds, zoom):
+        '''
+        get the composite and zoom level whose scale a histogram reduces at, when downgrading the
+        scale is coarsened before scenes are dropped
+        '''
+        scale_zoom = zoom
+        if self.budget.policy == 'downgrade':
+            scenes = self._count_scenes(bounds)
+            min_zoom = max(zoom - S2_HIST_MAX_COARSEN, 0)
+            while scale_zoom > min_zoom:
+                pixels = estimate_pixels(bounds, ZOOM_TO_SCALE[scale_zoom])
+                if scenes <= self.budget.get_max_scenes(pixels):
+                    break
+                scale_zoom -= 1
+
+        img, self.hist_estimate = self._get_budget_img(bounds, scale_zoom)
+
+        return img, scale_zoom
+
+
+    def compute_hist(self, bounds, zoom):
+        '''
+        compute histogram over given map bounds for selected bands, at the scale of a zoom level
+        '''
+        meta = Batch()
+        finish_meta = self.request_hist_meta(bounds, zoom, meta)
+        meta.evaluate()
+        finish_meta()
+
+        batch = Batch()
+        finish = self.request_hist(bounds, zoom, batch)
+        batch.evaluate()
+
+        return finish()
+
+
+    def request_hist_meta(self, bounds, zoom, batch):
+        '''
+        add the scene counts a histogram's budget decisions need to a batch, returns a function that
+        caches them once the batch is evaluated, so request_hist makes no round trips of its own
+        '''
+        with self.lock:
+            return self._request_scenes(bounds, batch)
+
+
+    def request_hist(self, bounds, zoom, batch):
+        '''
+        add the reductions needed for a histogram to a batch, returns a function that builds the
+        histogram once the batch is evaluated
+
+        the histogram is merged from cached cells of a fixed quadkey grid covering the bounds,
+        only cells that are not cached yet are added to the batch
+        '''
+        # the reductions are built from one state of the source, the finish function only reads copies
+        with self.lock:
+            return self._request_hist(bounds, zoom, batch)
+
+
+    def _request_hist(self, bounds, zoom, batch):
+        '''
+        add the reductions needed for a histogram to a batch, without taking the lock
+        '''
+        zoom = int(round(zoom))
+        grid_zoom = max(zoom - S2_HIST_GRID_OFFSET, 0)
+        cells = [tile_to_quadkey(x, y, grid_zoom) for x, y in tiles_in_bounds(bounds, grid_zoom)]
+
+        # the finest scale that stays within the pixel budget over the cells
+        cell_bounds = [tile_to_bounds(*quadkey_to_tile(quadkey)) for quadkey in cells]
+        scale_zoom = self._get_hist_scale_zoom(cell_bounds, zoom)
+
+        sample = self.hist_mode == 'sample' or (self.hist_mode == 'auto' and scale_zoom < zoom)
+        if sample:
+            # sampling fixes the number of pixels, so only scenes are dropped to stay within the cost budget
+            img, self.hist_estimate = self._get_budget_img(bounds, scale_zoom)
+            scale = ZOOM_TO_SCALE[zoom]
+            method = ('sample', scale, S2_HIST_CELL_SAMPLES)
+        else:
+            img, scale_zoom = self._get_hist_img(bounds, scale_zoom)
+            scale = ZOOM_TO_SCALE[scale_zoom]
+            method = ('reduce', scale)
+
+        img_hash = graph_hash(img)
+        active_bands = list(self.active_bands)
+        bins = dict()
+        for band_name in active_bands:
+            band = self.bands.get(band_name)
+            bins[band_name] = (band.get_min(), band.get_max(), S2_HIST_BINS)
+
+        # look up cached cell counts, batching reductions for the cells that are missing
+        counts = dict()
+        missing = dict()
+        for quadkey in cells:
+            for band_name in active_bands:
+                key = (img_hash, band_name, bins[band_name], method, quadkey)
+                cell_counts = S2_HIST_CELL_CACHE.get(key)
+                if cell_counts is None:
+                    if sample:
+                        cell_hist = self._sample_hist_cell(img, quadkey, band_name, bins[band_name], method)
+                    else:
+                        cell_hist = self._reduce_hist_cell(img, quadkey, band_name, bins[band_name], scale)
+                    missing[key] = batch.add(cell_hist)
+                counts[key] = cell_counts
+
+        def finish():
+            for key, batch_key in missing.items():
+                result = batch.get(batch_key)
+
+                # cells without valid pixels have no histogram
+                cell_counts = [0] * S2_HIST_BINS
+                if result is not None:
+                    # reduceRegion weights pixels by the area they cover, so counts can be fractional
+                    cell_counts = [round(count) for _, count in result]
+
+                S2_HIST_CELL_CACHE.set(key, cell_counts)
+                counts[key] = cell_counts
+
+            hist_dict = dict()
+            for band_name in active_bands:
+                lo, hi, n_bins = bins[band_name]
+                width = (hi - lo) / n_bins
+                bucket_means = [lo + (idx + 0.5) * width for idx in range(n_bins)]
+
+                hist = [0] * n_bins
+                for quadkey in cells:
+                    cell_counts = counts[(img_hash, band_name, bins[band_name], method, quadkey)]
+                    hist = [total + count for total, count in zip(hist, cell_counts)]
+
+                hist_dict[band_name] = (bucket_means, hist)
+
+            # bands can be masked differently, so the fewest pixels any band counted is reported
+            pixels = min([sum(hist) for _, hist in hist_dict.values()], default=0)
+            self.hist_stats = {'mode': method[0], 'scale': scale, 'pixels': pixels}
+
+            return hist_dict
+
+        return finish
+
+
+    def _get_hist_scale_zoom(self, cell_bounds, zoom):
+        '''
+        get the finest zoom level, no finer than the map's, whose scale reads the cells within the
+        histogram pixel budget
+        '''
+        for scale_zoom in range(zoom, 0, -1):
+            scale = ZOOM_TO_SCALE[scale_zoom]
+            if sum(bounds_to_pixels(bounds, scale) for bounds in cell_bounds) <= S2_HIST_PIXEL_BUDGET:
+                return scale_zoom
+
+        return 0
+
+
+    def _reduce_hist_cell(self, img, quadkey, band_name, bins, scale):
+        '''
+        get fixed-bin histogram of a band of an image over a grid cell as an ee object
+        '''
+        x, y, zoom = quadkey_to_tile(quadkey)
+        lo, hi, n_bins = bins
+
+        # the scale keeps cells within the pixel budget, so GEE does not have to coarsen it behind our back
+        hist = img.select(band_name).reduceRegion(
+            reducer=ee.Reducer.fixedHistogram(lo, hi, n_bins),
+            geometry=bounds_to_geom(tile_to_bounds(x, y, zoom)),
             scale=scale,
-            bestEffort=True
+            maxPixels=S2_HIST_PIXEL_BUDGET * S2_HIST_MAX_PIXELS_FACTOR
         )
 
-        hist_bands = hist.keys().getInfo()
-        hist_list = hist.values().getInfo()
-        hist_dict = dict()
-        for band_name in self.active_bands:
-            band_idx = hist_bands.index(band_name)
-            hist_dict[band_name] = (
-                hist_list[band_idx]['bucketMeans'],
-                hist_list[band_idx]['histogram']
-            )
+        return hist.get(band_name)
 
-        return hist_dict
+
+    def _sample_hist_cell(self, img, quadkey, band_name, bins, method):
+        '''
+        get fixed-bin histogram of a band of an image from random pixels of a grid cell as an ee object
+        '''
+        x, y, zoom = quadkey_to_tile(quadkey)
+        lo, hi, n_bins = bins
+        _, scale, num_pixels = method
+
+        # a fixed seed draws the same pixels again, so cached cells stay comparable
+        samples = img.select(band_name).sample(
+            region=bounds_to_geom(tile_to_bounds(x, y, zoom)),
+            scale=scale,
+            numPixels=num_pixels,
+            seed=0,
+            dropNulls=True
+        )
+
+        hist = samples.reduceColumns(ee.Reducer.fixedHistogram(lo, hi, n_bins), [band_name])
+
+        return hist.get('histogram')
 
 
     def update_ic(self):
         '''
         update image collection with newly set image parameters
         '''
-        self.ic = self._build_ic()
-        self._filter_clouds()
-        self._mask_clouds()
-        self._filter_date()
-        self._ic_to_image()
+        # the first build authenticates with GEE
+        initialize()
+
+        key = (tuple(self.collection_ids), self._get_ic_key())
+        shared = S2_IC_CACHE.get(key)
+        if shared is None:
+            self.plan = self._plan_ic()
+            self.ic = self._mask_clouds(self.plan.build())
+
+            S2_IC_CACHE.set(key, (self.plan, self.ic))
+        else:
+            self.plan, self.ic = shared
+
+        self.ic_key = key
+
+
+    def update_img(self):
+        '''
+        update image by applying the temporal operation to the image collection
+        '''
+        # keyed by the collection as built, so a composite is never stored under parameters set since
+        key = (self.ic_key, self._get_img_key())
+        img = S2_IMG_CACHE.get(key)
+        if img is None:
+            self._ic_to_image()
+
+            if self.aoi is not None:
+                self.img = self.img.clip(ee.Geometry(self.aoi))
+
+            S2_IMG_CACHE.set(key, self.img)
+        else:
+            self.img = img
 
+        self.img_key = key[1]
 
-    def set_active_bands(self, band_names, band_los, band_his):
+
+    def set_viewport(self, bounds, zoom=None):
         '''
-        set active bands for display and computation
+        track map bounds, returns True if they left the cached envelope and the collection is stale,
+        or if the zoom level changed and the composite has to be priced again
         '''
-        self.active_bands = band_names
-        for idx, (band_name, band_lo, band_hi) in enumerate(zip(band_names, band_los, band_his)):
-            self.bands.get(band_name).set_range(band_lo, band_hi)
-            
+        if not bounds:
+            return False
+
+        with self.lock:
+            rezoomed = False
+            if zoom is not None:
+                zoom = int(round(zoom))
+                rezoomed = self.viewport is not None and self.viewport[1] != zoom
+                self.viewport = (bounds, zoom)
+
+            if self.envelope is not None and contains_bounds(self.envelope, bounds):
+                return rezoomed
+
+            self.envelope = pad_bounds(bounds, S2_VIEWPORT_PAD)
+            return True
 
-    def update_viz(self):
+
+    def set_hist_mode(self, hist_mode):
         '''
-        update band visualization on map
+        set whether histograms reduce every pixel ('reduce'), random pixels ('sample') or random
+        pixels only for large views ('auto')
         '''
-        self.viz_params = self.get_viz_params()
+        with self.lock:
+            self.hist_mode = hist_mode
 
 
-    def get_viz_params(self):
+    def set_composite_mode(self, composite_mode):
         '''
-        get visualization parameters from bands in GEE format
+        set whether composites reduce the whole date window ('full') or merge per-month partial
+        aggregates ('monthly'), only mean, min and max can be merged
+
+        monthly partials are lazy ee graphs, so reusing them saves little locally, any saving comes
+        from GEE caching identical month graphs, which is not guaranteed, a merged mean is also more
+        server work than a single mean and panning past the envelope rebuilds every month
         '''
-        band_los = list()
-        band_his = list()
+        with self.lock:
+            self.composite_mode = composite_mode
 
-        for band_name in self.active_bands:
-            band = self.bands.get(band_name)
-            
-            lo, hi = band.get_range()
-            
-            band_los.append(lo)
-            band_his.append(hi)
 
-        viz_params = {
-            'min': band_los,
-            'max': band_his,
-            'bands': self.active_bands
-        }
+    def set_render_mode(self, render_mode):
+        '''
+        set whether tiles are stretched on GEE ('server') or from cached raw values ('local')
+        '''
+        with self.lock:
+            self.render_mode = render_mode
+
+
+    def read_tile(self, z, x, y, band_names):
+        '''
+        read raw band values of a tile for the local tile server
+        '''
+        # numpy and PIL are slow to import, so they are only loaded once tiles are stretched locally
+        from earthsight.imagery.rawtiles import get_raw_tile
+
+        # raw tiles are fetched outside the lock, so tiles of one source still load in parallel
+        with self.lock:
+            img = self._get_render_img()
+            min_vals = [self.bands.get(band_name).get_min() for band_name in band_names]
+        img_hash = graph_hash(img)
 
-        return viz_params
+        data = list()
+        valid = None
+        for band_name, min_val in zip(band_names, min_vals):
+            value, band_valid = get_raw_tile(img, img_hash, band_name, min_val, z, x, y)
+
+            data.append(value)
+            valid = band_valid if valid is None else valid & band_valid
+
+        return data, valid
 
 
     def get_url(self):
         '''
-        get tile layer as URL for an image and a set of viz parameters
+        get tile layer as URL for an image and a set of viz parameters, within the cost budget
         '''
-        url = image_to_tiles(self.img, self.viz_params)
+        url, _ = self.get_tiles()
         return url
 
+
+    def get_tiles(self):
+        '''
+        get tile layer URL and its stable key from the same state, the map ID is requested outside
+        the lock so updates and previews need not wait for it
+        '''
+        with self.lock:
+            img = self._get_render_img()
+            viz_params = self.viz_params
+            if self.render_mode == 'local':
+                return TILE_SERVER.register(self), None
+
+        return image_to_tiles(img, viz_params), graph_hash(img, viz_params)
+
+
+    def get_preview_url(self):
+        '''
+        get tile layer URL for a mosaic of the least cloudy scenes in the viewport, None when the
+        requested image is a mosaic already or tiles are stretched locally
+        '''
+        with self.lock:
+            if self.render_mode == 'local' or self.img_params.get_temporal_op() == 'mosaic':
+                return None
+
+            # the collection covers the padded envelope, scenes outside the view would leave it blank
+            ic = self.ic
+            if self.viewport is not None:
+                ic = ic.filterBounds(bounds_to_geom(self.viewport[0]))
+
+            aoi = self.aoi
+            viz_params = self.viz_params
+
+        # mosaic puts later images on top, so the least cloudy scene goes last
+        preview = (
+            ic
+            .sort('CLOUDY_PIXEL_PERCENTAGE')
+            .limit(S2_PREVIEW_SCENES)
+            .sort('CLOUDY_PIXEL_PERCENTAGE', False)
+            .mosaic()
+        )
+
+        if aoi is not None:
+            preview = preview.clip(ee.Geometry(aoi))
+
+        return image_to_tiles(preview, viz_params)
+
+
+    def get_tile_key(self):
+        '''
+        get a key for server-stretched tiles, map IDs expire but the image graph does not
+        '''
+        with self.lock:
+            if self.render_mode == 'local':
+                return None
+
+            return graph_hash(self._get_render_img(), self.viz_params)
+
+
+    def clone(self):
+        '''
+        get a new S2 source with default parameters over the same area
+        '''
+        clone = Sentinel2(collection_ids=self.collection_ids)
+
+        # the same area keeps cache keys equal, so the new layer reuses collections, composites and map IDs
+        clone.envelope = self.envelope
+        clone.viewport = self.viewport
+        clone.aoi = self.aoi
+
+        return clone
+
+
     # ------------- #
     # -- GETTERS -- #
     # ------------- #
-    def get_band_defs(self):
-        return S2_BAND_DEFS
+    def get_plan(self):
+        return self.plan
+
+
+    def get_estimate(self):
+        return self.estimate
+
+
+    def get_hist_estimate(self):
+        return self.hist_estimate
+
+
+    def get_hist_stats(self):
+        return self.hist_stats
 
 
-    def get_band_presets(self):
-        return S2_BAND_PRESETS
+    def get_name(self):
+        return 'Sentinel-2'
 
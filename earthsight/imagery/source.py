@@ -0,0 +1,303 @@
+'''
+source.py
+
+Class definition for ImagerySource, which provides a common interface for all imagery backends
+'''
+
+
+import threading
+
+
+# define processing stages in dependency order, a stale stage invalidates all stages after it
+STAGES = ['ic', 'img', 'viz']
+
+
+class ImagerySource:
+    def __init__(self, bands, band_presets, img_params):
+        '''
+        container for an imagery backend, subclasses build imagery, histograms and tile URLs
+        '''
+        # defaults are often shared module-level objects, so every source changes its own copy
+        self.bands = bands.copy()
+        self.band_presets = band_presets
+        self.img_params = img_params.copy()
+
+        self.active_bands = list()
+        self.viz_params = None
+
+        # drawn area of interest to clip to
+        self.aoi = None
+
+        # where tiles are stretched, 'server' or 'local', None for sources that cannot switch
+        self.render_mode = None
+
+        # parameters each stage was last built with
+        self.stage_keys = dict()
+
+        # updates and reads run on widget, timer and task threads, so a read never sees a source
+        # whose stages are half rebuilt
+        self.lock = threading.RLock()
+
+        # initialize visualization with the first preset
+        band_names, band_los, band_his = list(self.band_presets.values())[0]
+        self.set_active_bands(band_names, band_los, band_his)
+
+        # image collection, image and visualization are built by the first update, which callers
+        # can run in the background so constructing a source stays cheap
+
+
+    def _get_ic_key(self):
+        '''
+        get the parameters that the image collection stage depends on
+        '''
+        return ()
+
+
+    def _get_img_key(self):
+        '''
+        get the parameters that the image stage depends on
+        '''
+        return ()
+
+
+    def _get_stage_keys(self):
+        '''
+        get the parameters that each processing stage depends on
+        '''
+        viz_params = self.get_viz_params()
+        viz_key = (
+            tuple(viz_params['bands']),
+            tuple(viz_params['min']),
+            tuple(viz_params['max'])
+        )
+
+        stage_keys = {
+            'ic': self._get_ic_key(),
+            'img': self._get_img_key(),
+            'viz': viz_key
+        }
+
+        return stage_keys
+
+
+    def get_dirty(self):
+        '''
+        get stages whose parameters changed since they were last built
+        '''
+        stage_keys = self._get_stage_keys()
+
+        dirty = list()
+        for stage in STAGES:
+            if dirty or self.stage_keys.get(stage) != stage_keys[stage]:
+                dirty.append(stage)
+
+        return dirty
+
+
+    def update(self):
+        '''
+        rebuild only the stages invalidated by parameter changes, returns the rebuilt stages
+        '''
+        with self.lock:
+            stage_keys = self._get_stage_keys()
+            dirty = self.get_dirty()
+
+            if 'ic' in dirty:
+                self.update_ic()
+            if 'img' in dirty:
+                self.update_img()
+            if 'viz' in dirty:
+                self.update_viz()
+
+            for stage in dirty:
+                self.stage_keys[stage] = stage_keys[stage]
+
+        return dirty
+
+
+    def update_ic(self):
+        '''
+        update image collection with newly set image parameters
+        '''
+        raise NotImplementedError
+
+
+    def update_img(self):
+        '''
+        update image from the image collection
+        '''
+        raise NotImplementedError
+
+
+    def compute_hist(self, bounds, zoom):
+        '''
+        compute histogram over given map bounds for selected bands, at the scale of a zoom level
+        '''
+        raise NotImplementedError
+
+
+    def request_hist_meta(self, bounds, zoom, batch):
+        '''
+        add the metadata a histogram needs before its reductions are built to a batch, returns a
+        function that stores it once the batch is evaluated, sources that need none add nothing
+        '''
+        return lambda: None
+
+
+    def request_hist(self, bounds, zoom, batch):
+        '''
+        add the work needed for a histogram to a batch, returns a function that builds the
+        histogram once the batch is evaluated
+        '''
+        raise NotImplementedError
+
+
+    def get_url(self):
+        '''
+        get tile layer URL for the current image and viz parameters
+        '''
+        raise NotImplementedError
+
+
+    def get_tiles(self):
+        '''
+        get tile layer URL and its stable key from the same state, so an update cannot come between them
+        '''
+        with self.lock:
+            return self.get_url(), self.get_tile_key()
+
+
+    def get_preview_url(self):
+        '''
+        get tile layer URL for a cheap stand-in shown while the real image renders, or None if
+        the source has no preview
+        '''
+        return None
+
+
+    def get_estimate(self):
+        '''
+        get the cost estimate behind the last tile URL, or None if the source does not estimate costs
+        '''
+        return None
+
+
+    def get_hist_estimate(self):
+        '''
+        get the cost estimate behind the last histogram, or None if the source does not estimate costs
+        '''
+        return None
+
+
+    def get_hist_stats(self):
+        '''
+        get the mode, scale in meters and number of pixels behind the last histogram, or None if the
+        source does not report them
+        '''
+        return None
+
+
+    def get_tile_key(self):
+        '''
+        get a stable key for the tiles at get_url, so remote tiles can be cached across sessions,
+        or None if the tiles are already served locally
+        '''
+        return None
+
+
+    def clone(self):
+        '''
+        get a new source of the same kind with default parameters, e.g. for a new layer
+        '''
+        raise NotImplementedError
+
+
+    def set_viewport(self, bounds, zoom=None):
+        '''
+        track map bounds and zoom level, returns True if the source has to be updated for them
+        '''
+        return False
+
+
+    def set_render_mode(self, render_mode):
+        '''
+        set whether tiles are stretched on the server ('server') or locally ('local'), sources that
+        cannot switch ignore this
+        '''
+        pass
+
+
+    def set_aoi(self, aoi):
+        '''
+        set a GeoJSON geometry to restrict and clip imagery to, or None to clear it
+        '''
+        with self.lock:
+            self.aoi = aoi
+
+
+    def set_img_params(self, start_datetime, end_datetime, cloudy_pixel_pct, cloud_mask, temporal_op):
+        '''
+        set image parameters that define how an image is constructed
+        '''
+        with self.lock:
+            self.img_params.set(start_datetime, end_datetime, cloudy_pixel_pct, cloud_mask, temporal_op)
+
+
+    def set_active_bands(self, band_names, band_los, band_his):
+        '''
+        set active bands for display and computation
+        '''
+        with self.lock:
+            self.active_bands = band_names
+            for idx, (band_name, band_lo, band_hi) in enumerate(zip(band_names, band_los, band_his)):
+                self.bands.get(band_name).set_range(band_lo, band_hi)
+
+
+    def update_viz(self):
+        '''
+        update band visualization on map
+        '''
+        self.viz_params = self.get_viz_params()
+
+
+    def get_viz_params(self):
+        '''
+        get visualization parameters from bands in GEE format
+        '''
+        band_los = list()
+        band_his = list()
+
+        for band_name in self.active_bands:
+            band = self.bands.get(band_name)
+
+            lo, hi = band.get_range()
+
+            band_los.append(lo)
+            band_his.append(hi)
+
+        viz_params = {
+            'min': band_los,
+            'max': band_his,
+            'bands': self.active_bands
+        }
+
+        return viz_params
+
+
+    # ------------- #
+    # -- GETTERS -- #
+    # ------------- #
+    def get_band_defs(self):
+        band_defs = dict()
+        for band in self.bands.bands:
+            band_defs[band.get_name()] = (band.get_min(), band.get_max())
+
+        return band_defs
+
+
+    def get_band_presets(self):
+        return self.band_presets
+
+
+    def get_name(self):
+        return type(self).__name__
@@ -5,7 +5,6 @@ EarthMap class definition that builds a custom ipyleaflet map
 '''
 
 
-import bqplot as bq
 import datetime
 import ipyleaflet as ipyl
 import ipywidgets as ipyw
@@ -19,24 +18,29 @@ from earthsight.map.visualize import Visualize
 from earthsight.utils.constants import (BASEMAP_DEFAULT,
                                         CENTER_DEFAULT,
                                         ZOOM_DEFAULT)
+from earthsight.utils.prefetch import Prefetcher
+from earthsight.utils.timing import STARTUP
 
 
 class EarthMap:
     def __init__(self,
                  basemap=BASEMAP_DEFAULT,
                  center=CENTER_DEFAULT,
-                 zoom=ZOOM_DEFAULT):
+                 zoom=ZOOM_DEFAULT,
+                 img_src=None):
         '''
-        build ipyleaflet Map with custom widgets for interacting with imagery
+        build ipyleaflet Map with custom widgets for interacting with imagery, from S2 unless another
+        imagery source is given
         '''
         # create leaflet map
         self.map = self.create_map(basemap, center, zoom)
 
         # add basic interactive controls
         self.add_base_controls()
+        STARTUP.mark('basemap')
 
-        # control layers 
-        self.layers = Layers(self.map)
+        # control layers, the default layer is built and fetched in the background
+        self.layers = Layers(self.map, img_src)
 
         # control imagery options
         self.imagery = Imagery(self.map, self.layers)
@@ -45,7 +49,15 @@ class EarthMap:
         self.visualize = Visualize(self.map, self.layers)
 
         # control histogram options
-        self.histogram = Histogram(self.map, self.layers, self.visualize.band_sliders)
+        self.histogram = Histogram(self.map, self.layers, self.visualize)
+        STARTUP.mark('controls')
+
+        # warm tile caches around the viewport of all active layers
+        self.prefetcher = Prefetcher()
+
+        # restrict imagery to the viewport and to drawn areas of interest
+        self.map.observe(self._interact_viewport, names='bounds')
+        self.draw_control.on_draw(self._interact_draw)
 
 
     def create_map(self, basemap, center, zoom):
@@ -99,6 +111,42 @@ class EarthMap:
         }
         self.map.add_control(dc)
 
+        self.draw_control = dc
+
+
+    # ------------------ #
+    # -- INTERACTIONS -- #
+    # ------------------ #
+    def _interact_viewport(self, change):
+        '''
+        update layers whose cached envelope no longer covers the map bounds or whose cost depends on the
+        new zoom level, then prefetch tiles around them
+        '''
+        for layer in self.layers.get_all():
+            if layer.img_src.set_viewport(self.map.bounds, self.map.zoom):
+                layer.update()
+
+        # an empty map reports no bounds until it is rendered
+        if not self.map.bounds:
+            return
+
+        urls = [layer.url for layer in self.layers.get_active() if layer.url is not None]
+        self.prefetcher.prefetch(urls, self.map.bounds, self.map.zoom)
+
+
+    def _interact_draw(self, target, action, geo_json):
+        '''
+        clip layers to a drawn polygon, or stop clipping when it is deleted
+        '''
+        if action == 'deleted':
+            aoi = None
+        else:
+            aoi = geo_json['geometry']
+
+        for layer in self.layers.get_all():
+            layer.img_src.set_aoi(aoi)
+            layer.update()
+
 
     def show(self):
         '''
@@ -5,21 +5,26 @@ Histogram class definition that builds all widgets for Histogram pane
 '''
 
 
-import bqplot as bq
+from functools import partial
+import html
 import ipywidgets as ipyw
 import ipyleaflet as ipyl
 
-from earthsight.utils.constants import ZOOM_TO_SCALE
+from earthsight.utils.constants import (BUSY_HTML,
+                                        ERROR_HTML)
+from earthsight.utils.gee import Batch
+from earthsight.utils.tasks import TASKS
 
 
 class Histogram:
-    def __init__(self, m, layers, band_sliders):
+    def __init__(self, m, layers, visualize):
         '''
-        container for histogram pane on map
+        container for histogram pane on map, histograms of the selected layer are linked to the
+        band sliders of the visualize pane
         '''
         self.map = m
         self.layers = layers
-        self.band_sliders = band_sliders
+        self.visualize = visualize
 
         self._build_hist_button()
         self._add_controls()
@@ -56,9 +61,8 @@ class Histogram:
                 position='topleft'
             )
             self.map.add_control(self.hist_control)
-
-            self.hist_button.button_style = 'success'
         else:
+            TASKS.cancel(self)
             self.hist_button.button_style = ''
             [l.unlink() for l in self.hist_links]
             self.map.remove_control(self.hist_control)
@@ -68,6 +72,9 @@ class Histogram:
         '''
         get a bqplot histogram figure with data and interactive sliders
         '''
+        # bqplot is slow to import, so it is only loaded once a histogram is shown
+        import bqplot as bq
+
         x_scale = bq.LinearScale()
         y_scale = bq.LinearScale()
 
@@ -124,7 +131,7 @@ class Histogram:
             description='',
             icon='calculator',
             button_style='',
-            tooltip='Compute histogram across selected bands',
+            tooltip='Compute histogram across selected bands of active layers',
             layout=button_layout
         )
 
@@ -135,41 +142,123 @@ class Histogram:
 
     def _build_hist_pane(self):
         '''
-        build histogram pane which contains interactive histogram figures
+        build histogram pane, which shows a busy indicator until the histograms are computed
         '''
-        layer = self.layers.get_selected()
+        layers = self.layers.get_active()
 
         bounds = self.map.bounds
-        scale = ZOOM_TO_SCALE[self.map.zoom]
-    
-        hist = layer.img_src.compute_hist(bounds, scale)
+        zoom = self.map.zoom
+
+        self.hist_figs = list()
+        self.hist_links = list()
+        self.hist_pane = ipyw.VBox([ipyw.HTML(value=BUSY_HTML + ' computing histogram')])
+
+        TASKS.submit(
+            self,
+            partial(self._compute_hists, layers, bounds, zoom),
+            self._show_hists,
+            self._show_hist_error
+        )
+
+
+    def _compute_hists(self, layers, bounds, zoom):
+        '''
+        compute histograms for several layers in two round trips, one for the metadata budget decisions
+        depend on and one for the reductions
+        '''
+        meta = Batch()
+        finishers = [layer.img_src.request_hist_meta(bounds, zoom, meta) for layer in layers]
+        meta.evaluate()
+        for finish in finishers:
+            finish()
+
+        batch = Batch()
+        finishers = [layer.img_src.request_hist(bounds, zoom, batch) for layer in layers]
+        batch.evaluate()
+
+        hists = [(layer, finish()) for layer, finish in zip(layers, finishers)]
+        return hists
+
+
+    def _show_hists(self, hists):
+        '''
+        fill histogram pane with a row of interactive histogram figures per layer
+        '''
+        rows = list()
+        for layer, hist in hists:
+            # band sliders belong to the selected layer, so only its figures are linked to them
+            figs = self._get_hist_figures(hist, link=layer.selected)
+            label = ipyw.Label(value=self._get_hist_label(layer))
+            rows.append(ipyw.VBox([label, ipyw.HBox(figs)]))
+
+        self.hist_pane.children = rows
+        self.hist_button.button_style = 'success'
+
 
-        band_names = layer.img_src.active_bands
+    def _get_hist_label(self, layer):
+        '''
+        get a layer's name with the pixels its histogram was computed from, and the cost estimate
+        if it was over budget
+        '''
+        notes = list()
+
+        stats = layer.img_src.get_hist_stats()
+        if stats is not None:
+            verb = 'sampled' if stats['mode'] == 'sample' else 'reduced'
+            notes.append('{:,} px {} at {} m'.format(stats['pixels'], verb, stats['scale']))
+
+        estimate = layer.img_src.get_hist_estimate()
+        if estimate is not None and estimate.decision != 'ok':
+            notes.append(estimate.describe())
+
+        if not notes:
+            return layer.name
+
+        return '{} ({})'.format(layer.name, '; '.join(notes))
+
+
+    def _get_hist_figures(self, hist, link):
+        '''
+        get histogram figures for each band, optionally linked to the band sliders
+        '''
+        band_names = list(hist.keys())
         if len(band_names) == 1:
             colors = ['black']
         else:
             colors = ['red', 'green', 'blue']
 
-        self.hist_figs = list()
-        self.hist_links = list()
+        if link:
+            band_sliders = self.visualize.get_band_sliders()
+
+        figs = list()
         for bidx, band in enumerate(band_names):
             hist_data = hist[band]
             color = colors[bidx]
 
             hist_fig = self._get_hist_figure(hist_data[0], hist_data[1], color, bidx)
-            # TODO: these links are buggy
-            hist_link = ipyw.jslink(
-                (
-                    self.band_sliders[bidx],
-                    'value'
-                ),
-                (
-                    hist_fig.interaction,
-                    'selected'
+            if link:
+                # TODO: these links are buggy
+                hist_link = ipyw.jslink(
+                    (
+                        band_sliders[bidx],
+                        'value'
+                    ),
+                    (
+                        hist_fig.interaction,
+                        'selected'
+                    )
                 )
-            )
+                self.hist_links.append(hist_link)
 
+            figs.append(hist_fig)
             self.hist_figs.append(hist_fig)
-            self.hist_links.append(hist_link)
 
-        self.hist_pane = ipyw.HBox(self.hist_figs)
+        return figs
+
+
+    def _show_hist_error(self, exc):
+        '''
+        show that computing a histogram failed
+        '''
+        self.hist_pane.children = [ipyw.HTML(value=ERROR_HTML.format(html.escape(str(exc))) + ' histogram failed')]
+        self.hist_button.button_style = 'danger'
@@ -9,6 +9,8 @@ from datetime import datetime
 import ipywidgets as ipyw
 import ipyleaflet as ipyl
 
+from earthsight.utils.tasks import Debouncer
+
 
 class Imagery:
     def __init__(self, m, layers):
@@ -18,8 +20,13 @@ class Imagery:
         self.map = m
         self.layers = layers
 
+        # coalesce bursts of changes, e.g. stepping through dates, into a single update
+        self.img_debounce = Debouncer(self._update_img_params)
+
+        # the pane is built the first time it is opened
+        self.img_pane = None
+
         self._build_img_button()
-        self._build_img_pane()
 
         self._add_controls()
 
@@ -35,6 +42,8 @@ class Imagery:
 
         self.map.add_control(ibc)
 
+
+    def _add_pane_control(self):
         ipc = ipyl.WidgetControl(
             widget=self.img_pane,
             position='topleft'
@@ -50,6 +59,10 @@ class Imagery:
         '''
         toggle imagery pane
         '''
+        if self.img_pane is None:
+            self._build_img_pane()
+            self._add_pane_control()
+
         if self.img_button.button_style == '':
             self.img_button.button_style= 'success'
             self.img_pane.layout.display = ''
@@ -62,6 +75,13 @@ class Imagery:
         '''
         update selected layer with imagery parameters when something changes
         '''
+        self.img_debounce()
+
+
+    def _update_img_params(self):
+        '''
+        set imagery parameters on selected layer from widgets and update it
+        '''
         layer = self.layers.get_selected()
 
         start_datetime = self.date_start.value.strftime('%Y-%m-%d')
@@ -70,7 +90,7 @@ class Imagery:
         cloud_mask = self.cloud_mask.value
         temporal_op = self.temporal_op.value
 
-        layer.img_src.img_params.set(
+        layer.img_src.set_img_params(
             start_datetime,
             end_datetime,
             cloudy_pixel_pct,
@@ -5,91 +5,186 @@ Class definition for Layer, which provide a common interface for interacting wit
 '''
 
 
+from collections import OrderedDict
+from functools import partial
+import html
 import ipyleaflet as ipyl
 import ipywidgets as ipyw
+import os
+import threading
 
 from earthsight.map.basemaps import BASEMAPS
 from earthsight.imagery.sentinel2 import Sentinel2
+from earthsight.utils.constants import (BUSY_HTML,
+                                        ERROR_HTML,
+                                        MAP_SIZE_DEFAULT,
+                                        NOTICE_HTML)
+from earthsight.utils.tasks import TASKS
+from earthsight.utils.tiles import center_to_bounds
+from earthsight.utils.tileserver import TILE_SERVER
+from earthsight.utils.timing import STARTUP
 
 
-DEFAULT_LAYER_NAME = 'Sentinel-2'
-DEFAULT_IMG_SRC = Sentinel2()
+# serve remote tiles through the local caching proxy, so revisited areas load from disk, opt-in with
+# EARTHSIGHT_TILE_PROXY=1 since the browser has to reach the tile server, see EARTHSIGHT_TILE_URL
+LAYER_TILE_PROXY = os.environ.get('EARTHSIGHT_TILE_PROXY') == '1'
+
+# show a cheap preview while a new image renders, when its source provides one
+LAYER_PREVIEW = True
 
 
 class Layers:
-    def __init__(self, m):
+    def __init__(self, m, img_src=None):
         '''
-        container for layers pane on map
+        container for layers pane on map, new layers get a fresh copy of the default imagery source
         '''
         self.map = m
 
-        self.layers = list()
+        if img_src is None:
+            img_src = Sentinel2()
+        self.img_src = img_src
+
+        # the map reports its bounds only once rendered, so the first layer is built for a view around
+        # its center that the real bounds fall within, rather than being rebuilt when they arrive
+        bounds = center_to_bounds(self.map.center, self.map.zoom, MAP_SIZE_DEFAULT)
+        img_src.set_viewport(bounds, self.map.zoom)
 
-        self.ctr = 0
+        # layers and their widget rows by layer id, in the order they were added
+        self.layers = OrderedDict()
+        self.rows = dict()
+        self.selected = None
 
-        self.add(DEFAULT_LAYER_NAME, DEFAULT_IMG_SRC)
+        # tile layers this pane has put on the map, reconciled against the layers that should show
+        self.attached = list()
+        self.lock = threading.RLock()
+
+        self.ctr = 0
 
         self._build_layer_button()
         self._build_top_pane()
         self._build_layer_window()
-        self._update_selected()
+
+        self.add(img_src.get_name(), img_src)
 
         self._add_controls()
 
 
     def add(self, name, img_src):
         '''
-        add a new layer
+        add a new layer with a row in the layers pane, and select it
         '''
-        for layer in self.layers:
-            layer.selected = False
+        layer = Layer(name, self.ctr, img_src, self.map, on_change=self.reconcile)
 
-        layer = Layer(name, self.ctr, img_src, self.map)
-        self.layers.append(layer)
+        # reconcile runs on background threads as URLs arrive and iterates the layers
+        with self.lock:
+            self.layers[layer.ctr] = layer
         self.ctr += 1
 
+        row = self._build_single_layer(layer)
+        self.rows[layer.ctr] = row
+        self.layer_pane.children = self.layer_pane.children + (row,)
+
+        self.select(layer.ctr)
+
+        return layer
+
 
     def remove(self, layer):
         '''
-        remove a layer
+        remove a layer and its row, selecting the newest remaining layer if it was selected
         '''
-        self.layers.remove(layer)
-        
+        with self.lock:
+            del self.layers[layer.ctr]
+        row = self.rows.pop(layer.ctr)
+        self.layer_pane.children = tuple(child for child in self.layer_pane.children if child is not row)
+
+        layer.destroy()
+        self.reconcile()
 
-    def get(self, name):
+        if self.selected is layer:
+            self.selected = None
+            with self.lock:
+                newest = next(reversed(self.layers), None)
+            if newest is not None:
+                self.select(newest)
+
+
+    def select(self, layer_id):
         '''
-        get a layer by name
+        select a layer by id, so other panes modify it
         '''
-        this_layer = None
-        for layer in self.layers:
-            if layer.idx == idx:
-                selected_layer = layer
+        if self.selected is not None:
+            self.selected.selected = False
+            self.rows[self.selected.ctr].children[2].button_style = ''
 
-        return this_layer
+        layer = self.layers[layer_id]
+        layer.selected = True
+        self.rows[layer_id].children[2].button_style = 'info'
+
+        self.selected = layer
+
+
+    def reconcile(self):
+        '''
+        bring the map in line with the layers, touching only tile layers whose visibility or order changed
+        '''
+        with self.lock:
+            desired = [
+                layer.map_layer for layer in self.layers.values()
+                if layer.active and layer.map_layer is not None
+            ]
+
+            desired_ids = {id(map_layer) for map_layer in desired}
+            attached_ids = {id(map_layer) for map_layer in self.attached}
+
+            current = [map_layer for map_layer in self.map.layers if id(map_layer) in attached_ids]
+            if current == desired:
+                return
+
+            for map_layer in current:
+                if id(map_layer) not in desired_ids:
+                    self.map.remove_layer(map_layer)
+
+            kept = [map_layer for map_layer in current if id(map_layer) in desired_ids]
+            if kept == desired[:len(kept)]:
+                # only additions on top, which leaflet can do without redrawing the others
+                for map_layer in desired[len(kept):]:
+                    self.map.add_layer(map_layer)
+            else:
+                others = [map_layer for map_layer in self.map.layers if id(map_layer) not in attached_ids]
+                self.map.layers = tuple(others + desired)
+
+            self.attached = desired
+
+
+    def get(self, layer_id):
+        '''
+        get a layer by id
+        '''
+        return self.layers.get(layer_id)
+
+
+    def get_all(self):
+        '''
+        get all layers, in the order they were added
+        '''
+        with self.lock:
+            return list(self.layers.values())
 
 
     def get_selected(self):
         '''
         get selected layer which can be modified via other panes
         '''
-        this_layer = None
-        for layer in self.layers:
-            if layer.selected == True:
-                this_layer = layer
-        
-        return this_layer
+        return self.selected
 
 
     def get_active(self):
         '''
         get active layers, which show on map
         '''
-        these_layers = list()
-        for layer in self.layers:
-            if layer.active == True:
-                these_layers.append(layer)
-
-        return these_layers
+        with self.lock:
+            return [layer for layer in self.layers.values() if layer.active]
 
 
     # -------------- #
@@ -124,40 +219,22 @@ class Layers:
             self.map.remove_control(self.layer_control)
 
 
-
     def _interact_layer_add(self, b):
         '''
-        add a new layer
+        add a new layer, cloned from the selected layer so it covers the current view
         '''
-        name = 'layer {}'.format(self.ctr)
-        self.add(name, Sentinel2())
+        img_src = self.img_src if self.selected is None else self.selected.img_src
 
-        self.map.remove_control(self.layer_control)
-        self._build_layer_window()
-        self.layer_control = ipyl.WidgetControl(
-            widget=self.layer_window,
-            position='bottomright'
-        )
-        self.map.add_control(self.layer_control)
-
-        self._update_selected()
+        name = 'layer {}'.format(self.ctr)
+        self.add(name, img_src.clone())
 
 
     def _interact_layer_remove(self, b):
         '''
         remove selected layer
         '''
-        self.remove(self.get_selected())
-
-        self.map.remove_control(self.layer_control)
-        self._build_layer_window()
-        self.layer_control = ipyl.WidgetControl(
-            widget=self.layer_window,
-            position='bottomright'
-        )
-        self.map.add_control(self.layer_control)
-
-        self._update_selected()
+        if self.selected is not None:
+            self.remove(self.selected)
 
     
     def _interact_basemap(self, change):
@@ -171,55 +248,33 @@ class Layers:
         self.map.remove_layer(old_basemap)
 
     
-    def _interact_layer_text(self, change):
+    def _interact_layer_text(self, layer_id, change):
         '''
         update layer name
         '''
-        for layer, single_layer in zip(self.layers, self.single_layers):
-            layer.name = single_layer.children[0].value
+        self.layers[layer_id].name = change['new']
 
 
-    def _interact_layer_active(self, change):
+    def _interact_layer_active(self, layer_id, change):
         '''
-        show active layers on map
+        show or hide a layer, leaving all other layers untouched
         '''
-        for layer, single_layer in zip(self.layers, self.single_layers):
-            active = single_layer.children[1].value
-            layer.active = active
-            if active:
-                single_layer.children[1].button_style = 'info'
-                layer.create()
-            else:
-                single_layer.children[1].button_style = ''
-                layer.destroy()
-
+        layer = self.layers[layer_id]
+        layer_active = change['owner']
 
-    def _update_selected(self):
-        '''
-        update selected layer when a new layer is created
-        '''
-        layer_idx = len(self.layers) - 1
-        for idx, (layer, single_layer) in enumerate(zip(self.layers, self.single_layers)):
-            if idx == layer_idx:
-                layer.selected = True
-                single_layer.children[2].button_style = 'info'
-            else:
-                layer.selected = False
-                single_layer.children[2].button_style = ''
+        if layer_active.value:
+            layer_active.button_style = 'info'
+            layer.show()
+        else:
+            layer_active.button_style = ''
+            layer.hide()
 
 
-    def _interact_layer_selected(self, b):
+    def _interact_layer_selected(self, layer_id, b):
         '''
         update selected layer via button
         '''
-        layer_idx = int(b.tooltip) - 1
-        for layer, single_layer in zip(self.layers, self.single_layers):
-            if layer.ctr == layer_idx:
-                layer.selected = True
-                single_layer.children[2].button_style = 'info'
-            else:
-                layer.selected = False
-                single_layer.children[2].button_style = ''
+        self.select(layer_id)
 
 
     # ------------- #
@@ -289,12 +344,9 @@ class Layers:
 
     def _build_layer_window(self):
         '''
-        build layer window, which consists of single layers
+        build layer window, single layer rows are added to and removed from it one at a time
         '''
-        self.single_layers = list()
-        for layer in self.layers:
-            self._build_single_layer(layer)
-        self.layer_pane = ipyw.VBox(self.single_layers)
+        self.layer_pane = ipyw.VBox([])
 
         self.layer_window = ipyw.VBox([self.top_pane, self.layer_pane])
 
@@ -320,45 +372,64 @@ class Layers:
             icon='eye'
         )
 
-        # TODO: this is hacky. layer counter is encoded in the tooltip
         layout = ipyw.Layout(width='35px', height='35px')
         layer_selected = ipyw.Button(
             description='',
-            tooltip=str(layer.ctr + 1),
+            tooltip='select layer',
             button_style='',
             layout=layout,
             icon='check'
         )
 
-        layer_text.observe(self._interact_layer_text, names='value')
-        layer_active.observe(self._interact_layer_active, names='value')
-        layer_selected.on_click(self._interact_layer_selected)
+        # callbacks know their layer by id, so no row lookup is needed
+        layer_text.observe(partial(self._interact_layer_text, layer.ctr), names='value')
+        layer_active.observe(partial(self._interact_layer_active, layer.ctr), names='value')
+        layer_selected.on_click(partial(self._interact_layer_selected, layer.ctr))
 
         single_layer = ipyw.HBox(
             [
                 layer_text,
                 layer_active,
-                layer_selected
+                layer_selected,
+                layer.status
             ]
         )
 
-        self.single_layers.append(single_layer)
+        return single_layer
         
 
 class Layer:
-    def __init__(self, name, ctr, img_src, m, selected=True, active=True):
+    def __init__(self, name, ctr, img_src, m, selected=True, active=True, on_change=None):
         '''
-        container for an individual layer
+        container for an individual layer, on_change is called when its tile layer should be
+        attached to or detached from the map
         '''
         self.name = name
         self.ctr = ctr
         self.img_src = img_src
         self.map = m
+        self.on_change = on_change
 
         self.active = True
         self.selected = True
         
         self.map_layer = None
+        self.url = None
+
+        # set once the source's stages have been built for the first time
+        self.loaded = False
+
+        # set when the source changed while hidden, so its URL is fetched when shown again
+        self.stale = False
+
+        # each fetch gets a new version, a preview only shows if its version is current and the
+        # final URL for it has not arrived yet
+        self.version = 0
+        self.final_ready = False
+        self.lock = threading.Lock()
+
+        # indicator shown in the layers pane while a URL is being fetched
+        self.status = ipyw.HTML(value='', layout=ipyw.Layout(width='20px'))
 
         self.create()
 
@@ -367,32 +438,174 @@ class Layer:
         '''
         get URL for current layer configuration
         '''
-        url = self.img_src.get_url()
+        url, key = self.img_src.get_tiles()
+        if LAYER_TILE_PROXY and key is not None:
+            url = TILE_SERVER.register_proxy(key, url)
+
         return url
 
 
     def create(self):
         '''
-        create layer and throw on the map
+        create layer and throw on the map once its source is built and its URL fetched in the background
+        '''
+        self._set_busy(True)
+        TASKS.submit(self, self._load_url, self._show_url, self._show_error)
+
+
+    def _load_url(self):
+        '''
+        build all stages of the source, then get its URL
+        '''
+        self.img_src.update()
+        return self.get_url()
+
+
+    def show(self):
+        '''
+        show layer again, instantly from its detached tile layer unless its source changed while hidden
+        '''
+        self.active = True
+        self._changed()
+
+        if self.stale:
+            self.stale = False
+            self._fetch_url()
+
+
+    def hide(self):
         '''
-        url = self.get_url()
-        self.map_layer = ipyl.TileLayer(url=url, name=self.name)
-        self.map.add_layer(self.map_layer)
+        take layer off the map, keeping its tile layer and URL so it can be shown again
+        '''
+        self.active = False
+        self._changed()
 
 
     def destroy(self):
         '''
-        remove layer from the map
+        remove layer from the map for good, discarding any URL still being fetched
         '''
-        if self.map_layer is not None:
-            self.map.remove_layer(self.map_layer)
-            self.map_layer = None
+        TASKS.cancel(self)
+        TASKS.cancel((self, 'preview'))
+        self._set_busy(False)
+
+        self.active = False
+        self.map_layer = None
 
 
     def update(self):
         '''
-        update configuration of layer
+        update configuration of layer, only fetching a new URL when something changed
+        '''
+        # still loading, so restart the load which picks up the latest settings
+        if not self.loaded:
+            self.create()
+            return
+
+        dirty = self.img_src.update()
+        if dirty:
+            if self.active:
+                # new imagery may be slow to render, a viz change alone is not
+                self._fetch_url(preview='ic' in dirty or 'img' in dirty)
+            else:
+                self.stale = True
+
+
+    def _fetch_url(self, preview=False):
+        '''
+        fetch URL in the background, a newer fetch for this layer supersedes older ones, optionally
+        showing a preview until the URL arrives
+        '''
+        self._set_busy(True)
+
+        with self.lock:
+            self.version += 1
+            self.final_ready = False
+            version = self.version
+
+        TASKS.submit(self, self.get_url, self._show_url, self._show_error)
+
+        if preview and LAYER_PREVIEW:
+            TASKS.submit(
+                (self, 'preview'),
+                self.img_src.get_preview_url,
+                partial(self._show_preview, version),
+                self._ignore_error
+            )
+
+
+    def _show_url(self, url):
+        '''
+        swap a freshly fetched URL into the tile layer, replacing any preview
+        '''
+        with self.lock:
+            self.final_ready = True
+            self.url = url
+            self.loaded = True
+
+            self._set_tile_url(url)
+
+        STARTUP.mark('first layer')
+
+        self._set_busy(False)
+        self._show_estimate()
+
+
+    def _show_preview(self, version, url):
+        '''
+        show a preview URL, unless a newer fetch started or its final URL is already showing
+        '''
+        with self.lock:
+            if url is None or version != self.version or self.final_ready:
+                return
+
+            self._set_tile_url(url)
+
+
+    def _ignore_error(self, exc):
+        '''
+        drop a failed preview, the final URL follows anyway
+        '''
+        pass
+
+
+    def _set_tile_url(self, url):
+        '''
+        point the tile layer at a URL, creating it if needed
+        '''
+        if self.map_layer is None:
+            self.map_layer = ipyl.TileLayer(url=url, name=self.name)
+            self._changed()
+        elif self.map_layer.url != url:
+            self.map_layer.url = url
+
+
+    def _changed(self):
+        '''
+        ask for the tile layer to be attached or detached to match whether the layer is active
+        '''
+        if self.on_change is not None:
+            self.on_change()
+
+
+    def _show_estimate(self):
+        '''
+        show the cost estimate when the source warned about or downgraded the image
+        '''
+        estimate = self.img_src.get_estimate()
+        if estimate is not None and estimate.decision != 'ok':
+            self.status.value = NOTICE_HTML.format(html.escape(estimate.describe()))
+
+
+    def _show_error(self, exc):
+        '''
+        show that fetching a URL failed
+        '''
+        self.status.value = ERROR_HTML.format(html.escape(str(exc)))
+
+
+    def _set_busy(self, busy):
+        '''
+        toggle busy indicator
         '''
-        self.img_src.update_ic()
-        self.img_src.update_viz()
-        self.map_layer.url = self.get_url()
+        self.status.value = BUSY_HTML if busy else ''
@@ -5,6 +5,7 @@ Visualize class definition that builds all widgets for Visualize pane
 '''
 
 
+from contextlib import contextmanager
 import ipyleaflet as ipyl
 import ipywidgets as ipyw
 
@@ -16,9 +17,15 @@ class Visualize:
         '''
         self.map = m
         self.layers = layers
-        
+
+        # renders are deferred while a batch of widget changes is applied
+        self.batch_depth = 0
+        self.batch_pending = False
+
+        # the pane is built the first time it is opened, or when its sliders are needed
+        self.viz_pane = None
+
         self._build_viz_button()
-        self._build_viz_pane()
 
         self._add_controls()
 
@@ -34,6 +41,8 @@ class Visualize:
 
         self.map.add_control(vbc)
 
+
+    def _add_pane_control(self):
         vpc = ipyl.WidgetControl(
             widget=self.viz_pane,
             position='topleft'
@@ -42,6 +51,67 @@ class Visualize:
         self.map.add_control(vpc)
 
 
+    # ------------- #
+    # -- GETTERS -- #
+    # ------------- #
+    def get_band_sliders(self):
+        '''
+        get band sliders, building the pane if it has not been opened yet
+        '''
+        if self.viz_pane is None:
+            self._build_viz_pane()
+            self._add_pane_control()
+
+        return self.band_sliders
+
+
+    # ------------- #
+    # -- BATCHES -- #
+    # ------------- #
+    @contextmanager
+    def batch(self):
+        '''
+        suspend renders while applying several widget changes, then render at most once
+        '''
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0 and self.batch_pending:
+                self.batch_pending = False
+                self._render()
+
+
+    def _render(self):
+        '''
+        set active bands on selected layer from widgets and update it, deferred inside a batch
+        '''
+        if self.batch_depth > 0:
+            self.batch_pending = True
+            return
+
+        layer = self.layers.get_selected()
+
+        band_names = list()
+        band_los = list()
+        band_his = list()
+
+        for band_selector, band_slider in zip(self.band_selectors, self.band_sliders):
+            band_name = band_selector.value
+            band_lo, band_hi = band_slider.value
+
+            band_names.append(band_name)
+            band_los.append(band_lo)
+            band_his.append(band_hi)
+
+            if self.single_band.value == True:
+                break
+
+        layer.img_src.set_active_bands(band_names, band_los, band_his)
+        layer.update()
+
+
     # ------------------ #
     # -- INTERACTIONS -- #
     # ------------------ #
@@ -49,6 +119,10 @@ class Visualize:
         '''
         toggle viz pane
         '''
+        if self.viz_pane is None:
+            self._build_viz_pane()
+            self._add_pane_control()
+
         if self.viz_button.button_style == '':
             self.viz_button.button_style = 'success'
             self.viz_pane.layout.display = ''
@@ -66,18 +140,23 @@ class Visualize:
 
         band_names, band_los, band_his = layer.img_src.get_band_presets()[preset]
 
-        if len(band_names) == 1:
-            self.single_band.value = True
-        else:
-            self.single_band.value = False
+        # store preset ranges first so band selector changes pick them up
+        layer.img_src.set_active_bands(band_names, band_los, band_his)
+
+        with self.batch():
+            if len(band_names) == 1:
+                self.single_band.value = True
+            else:
+                self.single_band.value = False
+
+            for idx, (band_name, band_lo, band_hi) in enumerate(zip(band_names, band_los, band_his)):
+                band = layer.img_src.bands.get(band_name)
 
-        for idx, (band_name, band_lo, band_hi) in enumerate(zip(band_names, band_los, band_his)):
-            band = layer.img_src.bands.get(band_name)
+                self.band_selectors[idx].value = band_name
+                self._set_slider_limits(self.band_sliders[idx], band.get_min(), band.get_max())
+                self.band_sliders[idx].value = (band_lo, band_hi)
 
-            self.band_selectors[idx].value = band_name
-            self.band_sliders[idx].value = (band_lo, band_hi)
-            self.band_sliders[idx].min = band.get_min()
-            self.band_sliders[idx].max = band.get_max()
+            self._render()
 
 
     def _interact_single_band(self, change):
@@ -98,60 +177,55 @@ class Visualize:
         self._interact_select_change(None)
 
 
+    def _interact_local_stretch(self, change):
+        '''
+        stretch tiles of selected layer locally from cached raw values, if its source supports it
+        '''
+        layer = self.layers.get_selected()
+        render_mode = 'local' if self.local_stretch.value else 'server'
+        layer.img_src.set_render_mode(render_mode)
+        layer.update()
+
+
     def _interact_select_change(self, change):
         '''
         when a new band is chosen, update the sliders and set active bands
         '''
         layer = self.layers.get_selected()
 
-        band_names = list()
-        band_los = list()
-        band_his = list()
+        # slider changes below would each trigger a render
+        with self.batch():
+            for band_selector, band_slider in zip(self.band_selectors, self.band_sliders):
+                band = layer.img_src.bands.get(band_selector.value)
 
-        for band_selector, band_slider in zip(self.band_selectors, self.band_sliders):
-            band_name = band_selector.value
+                # set limits first so the range is not clamped to the previous band's limits
+                self._set_slider_limits(band_slider, band.get_min(), band.get_max())
+                band_slider.value = band.get_range()
 
-            band = layer.img_src.bands.get(band_name)
-            band_slider.value = band.get_range()
-            band_slider.min = band.get_min()
-            band_slider.max = band.get_max()
-            
-            band_lo, band_hi = band_slider.value
+                if self.single_band.value == True:
+                    break
 
-            band_names.append(band_name)
-            band_los.append(band_lo)
-            band_his.append(band_hi)
+            self._render()
 
-            if self.single_band.value == True:
-                break
 
-        layer.img_src.set_active_bands(band_names, band_los, band_his)
-        layer.update()
+    def _set_slider_limits(self, band_slider, min_val, max_val):
+        '''
+        set a slider's limits, widening it first since min may never exceed max, e.g. when moving
+        between bands whose ranges do not overlap
+        '''
+        if min_val > band_slider.max:
+            band_slider.max = max_val
+            band_slider.min = min_val
+        else:
+            band_slider.min = min_val
+            band_slider.max = max_val
 
 
     def _interact_slider_change(self, change):
         '''
         when a band slider is changed, update the band range values and visualization
         '''
-        layer = self.layers.get_selected()
-
-        band_names = list()
-        band_los = list()
-        band_his = list()
-
-        for band_selector, band_slider in zip(self.band_selectors, self.band_sliders):
-            band_name = band_selector.value
-            band_lo, band_hi = band_slider.value
-
-            band_names.append(band_name)
-            band_los.append(band_lo)
-            band_his.append(band_hi)
-
-            if self.single_band.value == True:
-                break
-
-        layer.img_src.set_active_bands(band_names, band_los, band_his)
-        layer.update()
+        self._render()
 
 
     # ------------- #
@@ -191,21 +265,35 @@ class Visualize:
 
         band_presets.observe(self._interact_band_presets, names='value')
 
+        # start from the bands the layer is showing, repeated when it shows a single band
+        active_bands = layer.img_src.active_bands
+
         single_band = ipyw.Checkbox(
-            value=False,
+            value=len(active_bands) == 1,
             description='single band',
             continuous_update=False
         )
 
         single_band.observe(self._interact_single_band, names='value')
 
-        # TODO: band defaults should not live here in widget initialization
+        # raw values are fetched once, after that stretch changes are rendered without GEE
+        local_stretch = ipyw.Checkbox(
+            value=layer.img_src.render_mode == 'local',
+            disabled=layer.img_src.render_mode is None,
+            description='local stretch',
+            continuous_update=False
+        )
+
+        local_stretch.observe(self._interact_local_stretch, names='value')
+
         all_band_names = layer.img_src.get_band_defs().keys()
         colors = ['red', 'green', 'blue']
-        defaults = ['B4', 'B3', 'B2']
+        defaults = (active_bands * 3)[:3]
         band_selectors = list()
         band_sliders = list()
         for color, default in zip(colors, defaults):
+            band = layer.img_src.bands.get(default)
+
             band_selector = ipyw.Dropdown(
                 options=all_band_names,
                 value=default,
@@ -214,9 +302,9 @@ class Visualize:
             )
 
             band_slider = ipyw.IntRangeSlider(
-                value=[500, 3500],
-                min=0,
-                max=10000,
+                value=band.get_range(),
+                min=band.get_min(),
+                max=band.get_max(),
                 step=1,
                 continuous_update=False,
                 orientation='horizontal',
@@ -245,6 +333,7 @@ class Visualize:
             [
                 band_presets,
                 single_band,
+                local_stretch,
                 band_panes[0],
                 band_panes[1],
                 band_panes[2]
@@ -253,10 +342,17 @@ class Visualize:
 
         self.band_presets = band_presets
         self.single_band = single_band
+        self.local_stretch = local_stretch
         self.band_selectors = band_selectors
         self.band_sliders = band_sliders
         self.band_panes = band_panes
         self.viz_pane = viz_pane
 
+        # only show one band when starting from a single band
+        if self.single_band.value == True:
+            self.band_selectors[0].description = 'gray'
+            self.band_panes[1].layout.display = 'none'
+            self.band_panes[2].layout.display = 'none'
+
         # don't display until button is pressed
         self.viz_pane.layout.display = 'none'
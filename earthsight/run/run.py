@@ -5,14 +5,79 @@ Entry-point for command line execution
 '''
 
 
+import argparse
 import os
 
+from earthsight.run.server import (ManagedServer,
+                                   SERVER_POOL_SIZE,
+                                   SERVER_PORT)
+
+
+# seconds to wait for the first layer when reporting startup timings
+TIMING_TIMEOUT = 120
+
+
+def report_timing():
+    '''
+    build a map the way the notebook does and print how long each startup milestone took
+    '''
+    # imported here so timings start before earthsight's own imports
+    from earthsight.utils.timing import STARTUP
+    from earthsight.map.earthmap import EarthMap
+    STARTUP.mark('import')
+
+    EarthMap()
+    if not STARTUP.wait('first layer', TIMING_TIMEOUT):
+        print('first layer not shown after {} s'.format(TIMING_TIMEOUT))
+
+    print(STARTUP.report())
+
 
 def main():
+    parser = argparse.ArgumentParser(description='Explore earth observation data in voila')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help='port to serve the viewer on')
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=SERVER_POOL_SIZE,
+        help='number of kernels kept warm with the map already built'
+    )
+    parser.add_argument(
+        '--status-port',
+        type=int,
+        default=None,
+        help='port for the /health and /timing endpoints, defaults to the next port'
+    )
+    parser.add_argument('--no-browser', action='store_true', help='do not open a browser')
+    parser.add_argument(
+        '--cache-backend',
+        default='sqlite',
+        help="where kernels share results, 'memory', 'sqlite' or a redis://host:port/db URL"
+    )
+    parser.add_argument(
+        '--timing',
+        action='store_true',
+        help='print a startup timing report instead of launching voila'
+    )
+    args = parser.parse_args()
+
+    if args.timing:
+        report_timing()
+        return
+
     dir_path = os.path.dirname(os.path.realpath(__file__))
     notebook_file = os.path.join(dir_path, 'earthsight.ipynb')
-    cmd = 'voila --enable_nbextensions=True {}'.format(notebook_file)
-    os.system(cmd)
+
+    server = ManagedServer(
+        notebook_file,
+        port=args.port,
+        pool_size=args.pool_size,
+        status_port=args.status_port,
+        open_browser=not args.no_browser,
+        cache_backend=args.cache_backend
+    )
+    server.start()
+    server.wait()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,295 @@
+'''
+server.py
+
+Class definition for ManagedServer, which runs voila with a pool of pre-warmed kernels sharing a cache daemon,
+and reports on it
+'''
+
+
+import glob
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from earthsight.utils.cacheserver import (CacheServer,
+                                          CacheService,
+                                          get_backend)
+from earthsight.utils.timing import Timings
+
+
+# port voila serves the map viewer on
+SERVER_PORT = 8866
+
+# number of kernels kept running with earthsight imported and the default map built
+SERVER_POOL_SIZE = 2
+
+# seconds between checks that voila is still up
+SERVER_POLL_WAIT = 1
+
+# seconds to wait before restarting voila after it exits
+SERVER_RESTART_WAIT = 5
+
+# number of kernel startup reports returned by the timing endpoint, newest first
+SERVER_TIMING_REPORTS = 20
+
+
+class ManagedServer:
+    def __init__(self,
+                 notebook_file,
+                 port=SERVER_PORT,
+                 pool_size=SERVER_POOL_SIZE,
+                 status_port=None,
+                 open_browser=True,
+                 cache_backend='sqlite'):
+        '''
+        container for a supervised voila process that pre-heats a pool of kernels, so a new
+        session gets a kernel that has already executed the notebook
+
+        kernels share results through a cache daemon running in this process, so identical
+        computations from different sessions only go upstream once
+
+        health, timing and cache stats are served as JSON on a separate status port, next to voila's by default
+        '''
+        self.notebook_file = notebook_file
+        self.port = port
+        self.pool_size = pool_size
+        self.status_port = port + 1 if status_port is None else status_port
+        self.open_browser = open_browser
+        self.cache_backend = cache_backend
+
+        # kernels find their startup milestone directory and the cache socket here through the environment
+        self.run_dir = tempfile.mkdtemp(prefix='earthsight-')
+        self.timing_dir = os.path.join(self.run_dir, 'timing')
+        os.makedirs(self.timing_dir)
+        self.timings = Timings()
+
+        self.cache_socket = os.path.join(self.run_dir, 'cache.sock')
+        self.cache_server = None
+
+        self.process = None
+        self.ready = False
+        self.restarts = 0
+        self.stopping = False
+
+        self.httpd = None
+
+
+    def get_command(self):
+        '''
+        get the voila command line, kernels are pre-heated by executing the notebook ahead of requests
+        '''
+        cmd = [
+            sys.executable, '-m', 'voila',
+            '--port={}'.format(self.port),
+            '--enable_nbextensions=True',
+            '--preheat_kernel=True',
+            '--pool_size={}'.format(self.pool_size)
+        ]
+
+        if not self.open_browser:
+            cmd.append('--no-browser')
+
+        cmd.append(self.notebook_file)
+
+        return cmd
+
+
+    def start(self):
+        '''
+        start the cache daemon, voila, its supervisor and the status server
+        '''
+        self.cache_server = CacheServer(self.cache_socket, CacheService(get_backend(self.cache_backend)))
+        self.cache_server.start()
+
+        self._spawn()
+
+        self.httpd = HTTPServer(('127.0.0.1', self.status_port), StatusHandler)
+        self.httpd.managed_server = self
+
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self._supervise, daemon=True).start()
+
+
+    def wait(self):
+        '''
+        block until interrupted, then stop voila
+        '''
+        try:
+            while not self.stopping:
+                time.sleep(SERVER_POLL_WAIT)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+    def stop(self):
+        '''
+        stop voila, the status server and the cache daemon, then remove the run directory
+        '''
+        self.stopping = True
+
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+        if self.httpd is not None:
+            self.httpd.shutdown()
+
+        if self.cache_server is not None:
+            self.cache_server.shutdown()
+            self.cache_server.server_close()
+
+        # holds the cache socket and kernel timings, which are of no use once the server is gone
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+    def _spawn(self):
+        '''
+        start a voila process
+        '''
+        env = dict(
+            os.environ,
+            EARTHSIGHT_TIMING_DIR=self.timing_dir,
+            EARTHSIGHT_CACHE_SOCKET=self.cache_socket
+        )
+
+        self.ready = False
+        self.process = subprocess.Popen(self.get_command(), env=env)
+        self.timings.mark('voila started')
+
+
+    def _supervise(self):
+        '''
+        track when voila accepts connections and restart it if it exits
+        '''
+        while not self.stopping:
+            if self.process.poll() is not None:
+                time.sleep(SERVER_RESTART_WAIT)
+                if self.stopping:
+                    return
+
+                self.restarts += 1
+                self._spawn()
+            elif not self.ready and self._is_listening():
+                self.ready = True
+                self.timings.mark('voila ready')
+
+            time.sleep(SERVER_POLL_WAIT)
+
+
+    def _is_listening(self):
+        '''
+        check if voila accepts connections on its port
+        '''
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+
+    # ------------- #
+    # -- GETTERS -- #
+    # ------------- #
+    def get_health(self):
+        '''
+        get whether voila is running and serving, with the pool configuration
+        '''
+        if self.process is None or self.process.poll() is not None:
+            status = 'down'
+        elif self.ready:
+            status = 'ok'
+        else:
+            status = 'starting'
+
+        health = {
+            'status': status,
+            'pid': self.process.pid if self.process is not None else None,
+            'port': self.port,
+            'pool_size': self.pool_size,
+            'restarts': self.restarts,
+            'uptime_s': round(time.perf_counter() - self.timings.start)
+        }
+
+        return health
+
+
+    def get_timing(self):
+        '''
+        get launcher milestones and the startup milestones of the most recent kernels
+        '''
+        paths = sorted(
+            glob.glob(os.path.join(self.timing_dir, '*.json')),
+            key=os.path.getmtime,
+            reverse=True
+        )
+
+        kernels = list()
+        for path in paths[:SERVER_TIMING_REPORTS]:
+            try:
+                with open(path) as f:
+                    kernels.append(json.load(f))
+            except (OSError, ValueError):
+                # a kernel may be writing its report right now
+                continue
+
+        timing = {
+            'server': self.timings.get_marks(),
+            'kernels': kernels
+        }
+
+        return timing
+
+
+    def get_cache_stats(self):
+        '''
+        get hit, miss and coalescing counters of the cache daemon
+        '''
+        return self.cache_server.service.get_stats()
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        '''
+        respond to /health with 200 only while voila serves, and to /timing and /cache
+        '''
+        managed_server = self.server.managed_server
+
+        if self.path == '/health':
+            body = managed_server.get_health()
+            code = 200 if body['status'] == 'ok' else 503
+        elif self.path == '/timing':
+            body = managed_server.get_timing()
+            code = 200
+        elif self.path == '/cache':
+            body = managed_server.get_cache_stats()
+            code = 200
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args):
+        '''
+        keep status checks out of the console
+        '''
+        pass
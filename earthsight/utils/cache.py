@@ -0,0 +1,108 @@
+'''
+cache.py
+
+Class definition for LRUCache, which provides a bounded in-memory cache with expiry
+'''
+
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    def __init__(self, max_size, ttl=None):
+        '''
+        container that keeps the most recently used items, dropping items older than ttl seconds
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default=None):
+        '''
+        get an item by key, counting a hit or a miss
+        '''
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.time():
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.items[key]
+
+            self.misses += 1
+            return default
+
+
+    def set(self, key, value, ttl=None):
+        '''
+        set an item, expiring after ttl seconds or else the cache's ttl, evicting the least recently
+        used item when full
+        '''
+        if ttl is None:
+            ttl = self.ttl
+
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+
+        with self.lock:
+            self.items[key] = (value, expires)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+    def remove(self, key):
+        '''
+        remove an item if it exists
+        '''
+        with self.lock:
+            self.items.pop(key, None)
+
+
+    def clear(self):
+        '''
+        remove all items and reset counters
+        '''
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+    # ------------- #
+    # -- GETTERS -- #
+    # ------------- #
+    def get_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+
+        stats = {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate
+        }
+
+        return stats
+
+
+    def __contains__(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            return item is not None and (item[1] is None or item[1] > time.time())
+
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,454 @@
+'''
+cacheserver.py
+
+Class definitions for CacheService, CacheServer and CacheClient, which share computed results between all
+kernels of a deployment over a Unix socket, so identical computations only go upstream once
+'''
+
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from earthsight.utils.diskcache import (CACHE_DIR,
+                                        DISK_CACHE_MAX_BYTES,
+                                        DiskCache)
+
+
+# number of values kept by the memory backend
+CACHE_MEMORY_SIZE = 65536
+
+# seconds a kernel waits on another kernel computing the same value before computing it itself
+CACHE_LEASE_TIMEOUT = 120
+
+# default socket path of the cache daemon
+CACHE_SOCKET = os.path.join(CACHE_DIR, 'cache.sock')
+
+
+class MemoryBackend:
+    def __init__(self, max_size=CACHE_MEMORY_SIZE):
+        '''
+        container for values kept in the daemon's memory, lost when it exits
+        '''
+        self.max_size = max_size
+
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        '''
+        get an unexpired value by key
+        '''
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[1] <= time.time():
+                return default
+
+            self.items.move_to_end(key)
+            return item[0]
+
+
+    def set(self, key, value, ttl):
+        '''
+        set a value that expires after ttl seconds, dropping least recently used values when full
+        '''
+        with self.lock:
+            self.items[key] = (value, time.time() + ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+class RedisBackend:
+    def __init__(self, host='127.0.0.1', port=6379, db=0):
+        '''
+        container for values kept in a Redis-compatible server, spoken to over RESP
+        '''
+        self.host = host
+        self.port = port
+        self.db = db
+
+        # one connection per daemon thread
+        self.local = threading.local()
+
+
+    def _command(self, *args):
+        '''
+        send a command and read its reply, reconnecting once if the connection was dropped
+        '''
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            try:
+                if conn is None:
+                    conn = self._connect()
+                return self._send(conn, args)
+            except OSError:
+                self.local.conn = None
+                if attempt > 0:
+                    raise
+
+
+    def _connect(self):
+        '''
+        open a connection and select the database
+        '''
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        conn = sock.makefile('rwb')
+
+        self._send(conn, ('SELECT', str(self.db)))
+        self.local.conn = conn
+
+        return conn
+
+
+    def _send(self, conn, args):
+        '''
+        write a command as a RESP array of bulk strings, then parse the reply
+        '''
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+
+        conn.write(b''.join(parts))
+        conn.flush()
+
+        return self._read(conn)
+
+
+    def _read(self, conn):
+        '''
+        parse a RESP reply, only the types GET and SET return are needed
+        '''
+        line = conn.readline()
+        if not line:
+            raise ConnectionError('connection closed by redis')
+
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RuntimeError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            if size < 0:
+                return None
+            data = conn.read(size + 2)
+            return data[:-2]
+
+        raise RuntimeError('unexpected redis reply {!r}'.format(line))
+
+
+    def get(self, key, default=None):
+        '''
+        get a value by key, redis expires values itself
+        '''
+        data = self._command('GET', key)
+        if data is None:
+            return default
+
+        return json.loads(data)
+
+
+    def set(self, key, value, ttl):
+        '''
+        set a value that expires after ttl seconds
+        '''
+        self._command('SET', key, json.dumps(value), 'EX', int(ttl))
+
+
+def get_backend(spec):
+    '''
+    get a backend from 'memory', 'sqlite' or a redis://host:port/db URL
+    '''
+    if spec == 'memory':
+        return MemoryBackend()
+    if spec == 'sqlite':
+        return DiskCache(os.path.join(CACHE_DIR, 'cache.sqlite'), DISK_CACHE_MAX_BYTES)
+    if spec.startswith('redis://'):
+        parts = urlsplit(spec)
+        db = int(parts.path.strip('/') or 0)
+        return RedisBackend(parts.hostname or '127.0.0.1', parts.port or 6379, db)
+
+    raise ValueError('unknown cache backend {}'.format(spec))
+
+
+class CacheService:
+    def __init__(self, backend, lease_timeout=CACHE_LEASE_TIMEOUT):
+        '''
+        container for a backend that hands out leases on misses, so when many kernels miss the same
+        key only the first computes it and the rest wait for its result
+        '''
+        self.backend = backend
+        self.lease_timeout = lease_timeout
+
+        # keys being computed, each with an event set once the result is stored or the lease released
+        self.leases = dict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired_leases = 0
+
+
+    def get(self, key, lease=False):
+        '''
+        get a value, on a miss optionally take a lease or wait for the kernel holding one
+        '''
+        value = self.backend.get(key)
+        if value is not None:
+            with self.lock:
+                self.hits += 1
+            return {'hit': True, 'value': value}
+
+        if not lease:
+            with self.lock:
+                self.misses += 1
+            return {'hit': False}
+
+        while True:
+            with self.lock:
+                event = self.leases.get(key)
+                if event is None:
+                    self.leases[key] = threading.Event()
+                    self.misses += 1
+                    return {'hit': False, 'lease': True}
+
+            finished = event.wait(self.lease_timeout)
+
+            value = self.backend.get(key)
+            if value is not None:
+                with self.lock:
+                    self.coalesced += 1
+                return {'hit': True, 'value': value}
+
+            # the lease holder failed or is stuck, so the next waiter takes over
+            with self.lock:
+                if self.leases.get(key) is event:
+                    del self.leases[key]
+                    if not finished:
+                        self.expired_leases += 1
+
+
+    def set(self, key, value, ttl):
+        '''
+        store a value and wake kernels waiting on it
+        '''
+        self.backend.set(key, value, ttl)
+        self.release(key)
+
+
+    def release(self, key):
+        '''
+        give up a lease without a value, e.g. when the computation failed
+        '''
+        with self.lock:
+            event = self.leases.pop(key, None)
+
+        if event is not None:
+            event.set()
+
+
+    def get_stats(self):
+        '''
+        get hit, miss and coalescing counters, coalesced requests count as hits
+        '''
+        with self.lock:
+            total = self.hits + self.coalesced + self.misses
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'expired_leases': self.expired_leases,
+                'leases': len(self.leases),
+                'hit_rate': (self.hits + self.coalesced) / total if total else 0.0
+            }
+
+        return stats
+
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        '''
+        Unix socket server for a cache service, speaking one JSON request and reply per line
+        '''
+        # a socket left behind by a daemon that did not exit cleanly would block the bind
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        super().__init__(path, CacheHandler)
+        self.service = service
+
+
+    def start(self):
+        '''
+        serve in a background thread
+        '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+class CacheHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        '''
+        answer requests until the client disconnects
+        '''
+        service = self.server.service
+        for line in self.rfile:
+            request = json.loads(line)
+
+            op = request['op']
+            try:
+                if op == 'get':
+                    reply = service.get(request['key'], request.get('lease', False))
+                elif op == 'set':
+                    service.set(request['key'], request['value'], request['ttl'])
+                    reply = {'ok': True}
+                elif op == 'release':
+                    service.release(request['key'])
+                    reply = {'ok': True}
+                elif op == 'stats':
+                    reply = service.get_stats()
+                else:
+                    reply = {'error': 'unknown op {}'.format(op)}
+            except Exception as exc:
+                reply = {'error': str(exc)}
+
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class CacheClient:
+    def __init__(self, path=CACHE_SOCKET, timeout=CACHE_LEASE_TIMEOUT + 30):
+        '''
+        container for a connection to the cache daemon, one socket per thread
+
+        the daemon is an optimization, so when it is unreachable values are computed locally
+        '''
+        self.path = path
+        self.timeout = timeout
+
+        self.local = threading.local()
+
+
+    def _call(self, request):
+        '''
+        send a request and wait for its reply
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            conn = sock.makefile('rwb')
+            self.local.conn = conn
+
+        try:
+            conn.write(json.dumps(request).encode('utf-8') + b'\n')
+            conn.flush()
+            line = conn.readline()
+            if not line:
+                raise ConnectionError('cache daemon closed the connection')
+        except OSError:
+            self.local.conn = None
+            raise
+
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+
+        return reply
+
+
+    def get(self, key, default=None):
+        '''
+        get a value by key without taking a lease
+        '''
+        try:
+            reply = self._call({'op': 'get', 'key': key})
+        except (OSError, RuntimeError):
+            return default
+
+        return reply['value'] if reply['hit'] else default
+
+
+    def set(self, key, value, ttl):
+        '''
+        set a value that expires after ttl seconds
+        '''
+        try:
+            self._call({'op': 'set', 'key': key, 'value': value, 'ttl': ttl})
+        except (OSError, RuntimeError):
+            pass
+
+
+    def get_or_compute(self, key, fn, ttl):
+        '''
+        get a value, computing it with fn only if no kernel has it or is computing it already
+        '''
+        try:
+            reply = self._call({'op': 'get', 'key': key, 'lease': True})
+        except (OSError, RuntimeError):
+            return fn()
+
+        if reply['hit']:
+            return reply['value']
+
+        try:
+            value = fn()
+        except Exception:
+            # let a waiting kernel try instead
+            try:
+                self._call({'op': 'release', 'key': key})
+            except (OSError, RuntimeError):
+                pass
+            raise
+
+        self.set(key, value, ttl)
+
+        return value
+
+
+    def get_stats(self):
+        '''
+        get the daemon's hit, miss and coalescing counters
+        '''
+        return self._call({'op': 'stats'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share computed results between earthsight kernels')
+    parser.add_argument('--socket', default=CACHE_SOCKET, help='Unix socket path to listen on')
+    parser.add_argument(
+        '--backend',
+        default='sqlite',
+        help="'memory', 'sqlite' or a redis://host:port/db URL"
+    )
+    args = parser.parse_args()
+
+    server = CacheServer(args.socket, CacheService(get_backend(args.backend)))
+    print('serving cache on {}, set EARTHSIGHT_CACHE_SOCKET to use it'.format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,11 @@ import ipyleaflet as ipyl
 BASEMAP_DEFAULT = ipyl.basemaps.OpenStreetMap.HOT # OSM basemap is easy to navigate
 CENTER_DEFAULT = (35.7004, -105.9136) # Center of map default in Santa Fe
 ZOOM_DEFAULT = 9 # Default zoom level
+MAP_SIZE_DEFAULT = (1280, 800) # Map size in pixels assumed until the browser reports the map's bounds
+
+BUSY_HTML = '<i class="fa fa-spinner fa-spin"></i>' # shown while background work is pending
+ERROR_HTML = '<i class="fa fa-exclamation-triangle" title="{}"></i>' # shown when background work fails
+NOTICE_HTML = '<i class="fa fa-info-circle" title="{}"></i>' # shown when background work went ahead with changes
 
 
 # governs the scale as a function of zoom level for histogram computation
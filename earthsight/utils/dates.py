@@ -0,0 +1,31 @@
+'''
+dates.py
+
+Python utilities for working with date windows
+'''
+
+
+from datetime import datetime, timedelta
+
+
+# format of dates throughout earthsight, as used by GEE date filters
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def split_months(start_datetime, end_datetime):
+    '''
+    split a [start, end) date window into calendar month windows, the first and last may be partial months
+    '''
+    start = datetime.strptime(start_datetime, DATE_FORMAT)
+    end = datetime.strptime(end_datetime, DATE_FORMAT)
+
+    windows = list()
+    while start < end:
+        # first day of the following month
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        stop = min(next_month, end)
+
+        windows.append((start.strftime(DATE_FORMAT), stop.strftime(DATE_FORMAT)))
+        start = stop
+
+    return windows
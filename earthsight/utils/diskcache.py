@@ -0,0 +1,109 @@
+'''
+diskcache.py
+
+Class definition for DiskCache, which provides a persistent cache shared by all processes on a host
+'''
+
+
+import json
+import os
+import sqlite3
+import time
+
+from earthsight.utils.sqlitecache import SQLiteCache
+
+
+# persistent caches are shared by all kernels on this host, can be relocated with EARTHSIGHT_CACHE_DIR
+CACHE_DIR = os.environ.get(
+    'EARTHSIGHT_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'earthsight')
+)
+
+# largest total size of the default disk cache of map IDs and getInfo results in bytes
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class DiskCache(SQLiteCache):
+    table = 'entries'
+    key_columns = ('key',)
+
+    def __init__(self, path, max_bytes):
+        '''
+        container for a size-bounded SQLite cache of JSON values with per-entry expiry
+        '''
+        super().__init__(path, max_bytes)
+
+
+    def _create(self, conn):
+        '''
+        create the entries table if needed
+        '''
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT, size INTEGER, expires REAL, accessed REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+
+    def get(self, key, default=None):
+        '''
+        get an unexpired value by key
+        '''
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT value FROM entries WHERE key = ? AND expires > ?',
+                (key, now)
+            ).fetchone()
+            if row is None:
+                return default
+
+            self._touch(conn, (key,))
+        except sqlite3.Error:
+            # the cache is best effort, an unusable cache file behaves like a miss
+            return default
+
+        return json.loads(row[0])
+
+
+    def set(self, key, value, ttl):
+        '''
+        set a value that expires after ttl seconds, then evict entries to stay within size
+        '''
+        now = time.time()
+        value = json.dumps(value)
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (key, value, len(value), now + ttl, now)
+            )
+            conn.commit()
+            self._evict(conn, now)
+        except sqlite3.Error:
+            pass
+
+
+    def _evict(self, conn, now):
+        '''
+        drop expired entries, then least recently used entries until under the size limit
+        '''
+        conn.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+        conn.commit()
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total > self.max_bytes:
+            self._evict_lru(conn, total, self.max_bytes)
+
+
+    def clear(self):
+        '''
+        remove all entries
+        '''
+        try:
+            conn = self._connect()
+            conn.execute('DELETE FROM entries')
+            conn.commit()
+        except sqlite3.Error:
+            pass
@@ -6,15 +6,181 @@ Python utilities for working with Google Earth Engine
 
 
 import ee
+import hashlib
+import json
+import os
+import threading
+import time
 from shapely.geometry import box, mapping
 
+from earthsight.utils.cache import LRUCache
+from earthsight.utils.cacheserver import CacheClient
+from earthsight.utils.diskcache import (CACHE_DIR,
+                                        DISK_CACHE_MAX_BYTES,
+                                        DiskCache)
+from earthsight.utils.singleflight import SingleFlight
+
+
+# number of map IDs to keep in memory
+MAP_ID_CACHE_SIZE = 256
+
+# map IDs returned by getMapId expire server-side, so never serve one older than this (seconds)
+MAP_ID_TTL = 4 * 60 * 60
+
+# cache of tile URLs keyed by the hash of an image and its visualization parameters
+MAP_ID_CACHE = LRUCache(MAP_ID_CACHE_SIZE, ttl=MAP_ID_TTL)
+
+# persistent cache of map IDs and getInfo results
+DISK_CACHE = DiskCache(os.path.join(CACHE_DIR, 'cache.sqlite'), DISK_CACHE_MAX_BYTES)
+
+# cache daemon shared by all kernels of a deployment, which also coalesces identical requests
+SHARED_CACHE_SOCKET = os.environ.get('EARTHSIGHT_CACHE_SOCKET')
+SHARED_CACHE = CacheClient(SHARED_CACHE_SOCKET) if SHARED_CACHE_SOCKET else None
+
+# identical requests running at the same time in this kernel, keyed like the caches by graph hash
+IN_FLIGHT = SingleFlight()
+
+# set once ee.Initialize has been called for this process
+INITIALIZED = False
+INITIALIZE_LOCK = threading.Lock()
+
+# getInfo results can go stale as new scenes are ingested, so they expire after a day (seconds)
+INFO_TTL = 24 * 60 * 60
+
+
+def initialize():
+    '''
+    initialize GEE on first use rather than at import, so offline sources never need it
+    '''
+    global INITIALIZED
+    with INITIALIZE_LOCK:
+        if not INITIALIZED:
+            ee.Initialize()
+            INITIALIZED = True
+
+
+def graph_hash(ee_obj, params=None):
+    '''
+    get a canonical hash for an ee object's computation graph and optional parameters
+    '''
+    graph = ee_obj.serialize()
+    params = json.dumps(params, sort_keys=True)
+
+    digest = hashlib.sha1()
+    digest.update(graph.encode('utf-8'))
+    digest.update(params.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def get_shared(key, fn, ttl):
+    '''
+    get a value shared between kernels, from the cache daemon when one is configured and otherwise
+    from the disk cache, computing it with fn on a miss
+
+    concurrent calls for the same key in this kernel share a single lookup and computation
+    '''
+    return IN_FLIGHT.do(key, lambda: _get_shared(key, fn, ttl))
+
+
+def _get_shared(key, fn, ttl):
+    '''
+    get a value from the cache daemon or the disk cache, computing it with fn on a miss
+    '''
+    if SHARED_CACHE is not None:
+        return SHARED_CACHE.get_or_compute(key, fn, ttl)
+
+    value = DISK_CACHE.get(key)
+    if value is None:
+        value = fn()
+        DISK_CACHE.set(key, value, ttl)
+
+    return value
+
 
 def image_to_tiles(image, vis_params=None):
     '''
-    get a tile layer URL from an Image
+    get a tile layer URL from an Image, reusing a recent map ID for identical requests
+    '''
+    key = graph_hash(image, vis_params)
+    url = MAP_ID_CACHE.get(key)
+    if url is None:
+        # shared map IDs may have been issued hours ago, so they carry their expiry with them
+        map_id = get_shared(
+            'map/' + key,
+            lambda: {
+                'url': image.getMapId(vis_params)['tile_fetcher'].url_format,
+                'expires': time.time() + MAP_ID_TTL
+            },
+            MAP_ID_TTL
+        )
+        url = map_id['url']
+        MAP_ID_CACHE.set(key, url, map_id['expires'] - time.time())
+
+    return url
+
+
+def get_info(ee_obj):
+    '''
+    evaluate an ee object with getInfo, reusing results from any kernel on this host or deployment
+    '''
+    key = 'info/' + graph_hash(ee_obj)
+    info = get_shared(key, ee_obj.getInfo, INFO_TTL)
+
+    return info
+
+
+class Batch:
+    def __init__(self):
+        '''
+        container that packs pending ee computations so they are evaluated in a single getInfo
+        '''
+        self.pending = dict()
+        self.results = None
+
+
+    def add(self, ee_obj):
+        '''
+        add a computation, returns a key to get its result after evaluation
+        '''
+        # identical computations share a key, so they are only evaluated once
+        key = graph_hash(ee_obj)
+        self.pending[key] = ee_obj
+
+        return key
+
+
+    def evaluate(self):
+        '''
+        evaluate all pending computations in one round trip
+        '''
+        if self.pending:
+            self.results = get_info(ee.Dictionary(self.pending))
+        else:
+            self.results = dict()
+
+        self.pending = dict()
+
+
+    def get(self, key):
+        '''
+        get the result of an evaluated computation
+        '''
+        return self.results[key]
+
+
+def get_map_id_stats():
+    '''
+    get hit and miss counters for the map ID cache
     '''
-    map_id = image.getMapId(vis_params)
-    return map_id['tile_fetcher'].url_format
+    return MAP_ID_CACHE.get_stats()
+
+
+def get_in_flight_stats():
+    '''
+    get counts of executed and coalesced map ID and getInfo requests
+    '''
+    return IN_FLIGHT.get_stats()
 
 
 def bounds_to_geom(bounds):
@@ -32,6 +198,39 @@ def bounds_to_geom(bounds):
     return geom
 
 
+def pad_bounds(bounds, pad):
+    '''
+    grow leaflet map bounds by a fraction of their size on each side, clamped to valid coordinates
+    '''
+    min_lat, min_lon = bounds[0]
+    max_lat, max_lon = bounds[1]
+
+    pad_lat = (max_lat - min_lat) * pad
+    pad_lon = (max_lon - min_lon) * pad
+
+    padded = (
+        (max(min_lat - pad_lat, -90), max(min_lon - pad_lon, -180)),
+        (min(max_lat + pad_lat, 90), min(max_lon + pad_lon, 180))
+    )
+
+    return padded
+
+
+def contains_bounds(outer, inner):
+    '''
+    check if leaflet map bounds are fully inside other bounds
+    '''
+    (outer_min_lat, outer_min_lon), (outer_max_lat, outer_max_lon) = outer
+    (inner_min_lat, inner_min_lon), (inner_max_lat, inner_max_lon) = inner
+
+    contains = (
+        outer_min_lat <= inner_min_lat and outer_min_lon <= inner_min_lon and
+        outer_max_lat >= inner_max_lat and outer_max_lon >= inner_max_lon
+    )
+
+    return contains
+
+
 
 
 
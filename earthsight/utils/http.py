@@ -0,0 +1,89 @@
+'''
+http.py
+
+Class definition for ConnectionPool, which reuses keep-alive HTTP connections across requests
+'''
+
+
+import http.client
+import queue
+import threading
+from urllib.parse import urlsplit
+
+
+# number of idle connections kept open per host
+HTTP_POOL_SIZE = 8
+
+# seconds to wait on an upstream server
+HTTP_TIMEOUT = 30
+
+
+class ConnectionPool:
+    def __init__(self, max_idle=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+        '''
+        container for idle keep-alive connections per host, safe to use from many threads
+        '''
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+
+    def _acquire(self, scheme, netloc):
+        '''
+        get an idle connection to a host, or open a new one
+        '''
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), queue.LifoQueue(self.max_idle))
+
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+
+    def _release(self, scheme, netloc, conn):
+        '''
+        return a connection to the pool, closing it if the pool is full
+        '''
+        try:
+            self.idle[(scheme, netloc)].put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+    def get(self, url):
+        '''
+        GET a URL, returns status, content type and body
+        '''
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        # an idle connection may have been closed by the server, so retry once on a fresh one
+        for attempt in range(2):
+            conn = self._acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt > 0:
+                    raise
+                continue
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(parts.scheme, parts.netloc, conn)
+
+            return resp.status, resp.getheader('Content-Type'), body
+
+
+# shared connection pool for all upstream tile requests
+HTTP_POOL = ConnectionPool()
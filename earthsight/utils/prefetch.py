@@ -0,0 +1,157 @@
+'''
+prefetch.py
+
+Class definition for Prefetcher, which warms tile caches around the map viewport before tiles are requested
+'''
+
+
+import itertools
+import queue
+import threading
+
+from earthsight.utils.tiles import tiles_in_bounds
+from earthsight.utils.tileserver import TILE_SERVER
+
+
+# number of tiles fetched concurrently, kept below the tile server's pool so the browser is never starved
+PREFETCH_WORKERS = 4
+
+# width in tiles of the ring of neighbouring tiles around the viewport
+PREFETCH_RING = 1
+
+# most tiles queued per layer for one viewport
+PREFETCH_MAX_TILES = 256
+
+# deepest zoom level of the map, children are not prefetched beyond it
+PREFETCH_MAX_ZOOM = 20
+
+# tiles on screen go first, then the ring around them, then the parent and child zoom levels
+PRIORITY_VISIBLE = 0
+PRIORITY_RING = 1
+PRIORITY_PARENT = 2
+PRIORITY_CHILD = 3
+
+
+def get_prefetch_tiles(bounds, zoom, ring=PREFETCH_RING):
+    '''
+    get (priority, z, x, y) of tiles worth warming for a viewport, most important first
+    '''
+    n = 2 ** zoom
+    visible = tiles_in_bounds(bounds, zoom)
+
+    min_x = max(min(x for x, _ in visible) - ring, 0)
+    max_x = min(max(x for x, _ in visible) + ring, n - 1)
+    min_y = max(min(y for _, y in visible) - ring, 0)
+    max_y = min(max(y for _, y in visible) + ring, n - 1)
+
+    tiles = [(PRIORITY_VISIBLE, zoom, x, y) for x, y in visible]
+
+    visible = set(visible)
+    for y in range(min_y, max_y + 1):
+        for x in range(min_x, max_x + 1):
+            if (x, y) not in visible:
+                tiles.append((PRIORITY_RING, zoom, x, y))
+
+    # zooming out shows the parents of the ring
+    if zoom > 0:
+        parents = {(x >> 1, y >> 1) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1)}
+        tiles.extend((PRIORITY_PARENT, zoom - 1, x, y) for x, y in sorted(parents))
+
+    # zooming in shows the children of what is on screen
+    if zoom < PREFETCH_MAX_ZOOM:
+        for x, y in sorted(visible):
+            for dy in range(2):
+                for dx in range(2):
+                    tiles.append((PRIORITY_CHILD, zoom + 1, 2 * x + dx, 2 * y + dy))
+
+    return tiles
+
+
+class Prefetcher:
+    def __init__(self, tile_server=TILE_SERVER, workers=PREFETCH_WORKERS):
+        '''
+        container for a bounded pool of threads that warm a tile server's caches
+
+        each new viewport supersedes the last, so tiles queued for a view the map has moved away
+        from are dropped rather than fetched
+        '''
+        self.tile_server = tile_server
+        self.workers = workers
+
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+
+        self.generation = 0
+        self.lock = threading.Lock()
+
+        self.threads = list()
+
+
+    def _start(self):
+        '''
+        start worker threads on first use
+        '''
+        if self.threads:
+            return
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def prefetch(self, urls, bounds, zoom):
+        '''
+        queue tiles around a viewport for every tile URL template, cancelling those queued for earlier views
+        '''
+        # tiles the browser fetches straight from upstream have no cache here to warm
+        urls = [url for url in urls if self.tile_server.serves(url)]
+
+        zoom = int(round(zoom))
+        tiles = get_prefetch_tiles(bounds, zoom)[:PREFETCH_MAX_TILES]
+
+        with self.lock:
+            self._start()
+            self._drain()
+
+            self.generation += 1
+            for priority, z, x, y in tiles:
+                for url in urls:
+                    # the counter keeps tiles of equal priority in order and never compares URLs
+                    self.queue.put((priority, next(self.counter), self.generation, url, z, x, y))
+
+
+    def cancel(self):
+        '''
+        drop all queued tiles, tiles already being fetched are left to finish
+        '''
+        with self.lock:
+            self._drain()
+            self.generation += 1
+
+
+    def _drain(self):
+        '''
+        empty the queue
+        '''
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+    def _work(self):
+        '''
+        warm queued tiles until the process exits
+        '''
+        while True:
+            _, _, generation, url, z, x, y = self.queue.get()
+            if generation != self.generation:
+                continue
+
+            try:
+                self.tile_server.prefetch_tile(url, z, x, y)
+            except Exception:
+                # prefetching is best effort, the browser will request the tile again if it needs it
+                pass
@@ -0,0 +1,63 @@
+'''
+render.py
+
+Python utilities for rendering NumPy band arrays into PNG map tiles
+'''
+
+
+from functools import lru_cache
+import io
+
+import numpy as np
+from PIL import Image
+
+
+# integer bands with at most this many distinct values are stretched with a lookup table
+LUT_MAX_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=256)
+def stretch_lut(min_val, max_val, lo, hi):
+    '''
+    get a lookup table mapping every integer value in [min_val, max_val] to 0-255 for a lo/hi stretch
+    '''
+    values = np.arange(min_val, max_val + 1, dtype=np.float32)
+    lut = np.clip((values - lo) / max(hi - lo, 1e-6), 0, 1) * 255
+
+    lut = lut.astype(np.uint8)
+    lut.setflags(write=False)
+
+    return lut
+
+
+def stretch(data, lo, hi, min_val, max_val):
+    '''
+    stretch a band to 0-255 so lo maps to 0 and hi to 255, values are expected in [min_val, max_val]
+    '''
+    integer = np.issubdtype(data.dtype, np.integer)
+    if integer and max_val - min_val < LUT_MAX_SIZE:
+        # a single gather per pixel, instead of a subtract, divide and clip
+        lut = stretch_lut(int(min_val), int(max_val), lo, hi)
+        idx = np.clip(data, min_val, max_val).astype(np.int64) - int(min_val)
+        return lut[idx]
+
+    stretched = np.clip((data.astype(np.float32) - lo) / max(hi - lo, 1e-6), 0, 1) * 255
+    return stretched.astype(np.uint8)
+
+
+def render_png(data, valid, viz_params, ranges):
+    '''
+    render bands into a PNG, one band as gray and three as RGB, following GEE viz params
+    '''
+    channels = list()
+    for band_data, lo, hi, (min_val, max_val) in zip(data, viz_params['min'], viz_params['max'], ranges):
+        channels.append(stretch(band_data, lo, hi, min_val, max_val))
+
+    # transparent wherever there is no valid data
+    channels.append(valid.astype(np.uint8) * 255)
+
+    # a single band with alpha is saved as LA, three bands with alpha as RGBA
+    buf = io.BytesIO()
+    Image.fromarray(np.stack(channels, axis=-1)).save(buf, format='PNG')
+
+    return buf.getvalue()
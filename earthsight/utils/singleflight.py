@@ -0,0 +1,64 @@
+'''
+singleflight.py
+
+Class definition for SingleFlight, which lets concurrent identical calls share one execution
+'''
+
+
+from concurrent.futures import Future
+import threading
+
+
+class SingleFlight:
+    def __init__(self):
+        '''
+        container for calls in flight by key, a call made while an identical one is running waits
+        for that call's result instead of running again
+        '''
+        self.calls = dict()
+        self.lock = threading.Lock()
+
+        self.executed = 0
+        self.coalesced = 0
+
+
+    def do(self, key, fn):
+        '''
+        run fn, or wait for the call already running for key, and return its result or raise its error
+        '''
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as exc:
+            future.set_exception(exc)
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return future.result()
+
+
+    def get_stats(self):
+        '''
+        get counts of executed and coalesced calls, and of calls running now
+        '''
+        with self.lock:
+            stats = {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls)
+            }
+
+        return stats
@@ -0,0 +1,124 @@
+'''
+sqlitecache.py
+
+Class definition for SQLiteCache, the base of the SQLite caches shared by all processes on a host
+'''
+
+
+import os
+import sqlite3
+import threading
+import time
+
+
+# seconds between writes of buffered access times, reads would otherwise each need a write transaction
+SQLITE_TOUCH_WAIT = 30
+
+# most buffered access times before they are written regardless of the wait
+SQLITE_TOUCH_MAX = 1024
+
+
+class SQLiteCache:
+    # table of entries with a size and an accessed column, identified by the key columns
+    table = None
+    key_columns = ()
+
+    def __init__(self, path, max_bytes):
+        '''
+        container for a size-bounded SQLite cache evicted least recently used first
+
+        access times are buffered in memory and written in batches, so reads stay read-only
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+
+        # sqlite connections cannot be shared across threads
+        self.local = threading.local()
+
+        # access times by key waiting to be written
+        self.touched = dict()
+        self.touch_lock = threading.Lock()
+        self.last_flush = time.time()
+
+
+    def _create(self, conn):
+        '''
+        create tables and indices in a new connection's file if needed
+        '''
+        raise NotImplementedError
+
+
+    def _connect(self):
+        '''
+        get a connection for the current thread, creating the cache file if needed
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            # WAL lets readers in other kernels proceed while one kernel writes
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._create(conn)
+            conn.commit()
+
+            self.local.conn = conn
+
+        return conn
+
+
+    def _touch(self, conn, key):
+        '''
+        record that an entry was read, writing buffered access times once enough have built up
+        '''
+        now = time.time()
+        with self.touch_lock:
+            self.touched[key] = now
+            due = len(self.touched) >= SQLITE_TOUCH_MAX or now - self.last_flush >= SQLITE_TOUCH_WAIT
+
+        if due:
+            self._flush(conn)
+
+
+    def _flush(self, conn):
+        '''
+        write buffered access times
+        '''
+        with self.touch_lock:
+            touched = self.touched
+            self.touched = dict()
+            self.last_flush = time.time()
+
+        if not touched:
+            return
+
+        where = ' AND '.join('{} = ?'.format(column) for column in self.key_columns)
+        conn.executemany(
+            'UPDATE {} SET accessed = ? WHERE {}'.format(self.table, where),
+            [(accessed,) + key for key, accessed in touched.items()]
+        )
+        conn.commit()
+
+
+    def _evict_lru(self, conn, total, target):
+        '''
+        drop least recently used entries until their total size is at most target, returns the new total
+        '''
+        # recent reads have to count before deciding what is least recently used
+        self._flush(conn)
+
+        columns = ', '.join(self.key_columns)
+        rows = conn.execute('SELECT {}, size FROM {} ORDER BY accessed'.format(columns, self.table))
+
+        stale = list()
+        for row in rows:
+            if total <= target:
+                break
+            stale.append(row[:-1])
+            total -= row[-1]
+
+        where = ' AND '.join('{} = ?'.format(column) for column in self.key_columns)
+        conn.executemany('DELETE FROM {} WHERE {}'.format(self.table, where), stale)
+        conn.commit()
+
+        return total
@@ -0,0 +1,139 @@
+'''
+tasks.py
+
+Class definition for TaskRunner, which runs slow calls in the background so widget callbacks never block
+'''
+
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import traceback
+
+
+# number of background workers shared by all layers and panes
+TASK_WORKERS = 4
+
+# default window over which bursts of widget changes are coalesced (seconds)
+DEBOUNCE_WAIT = 0.3
+
+
+class TaskRunner:
+    def __init__(self, max_workers=TASK_WORKERS):
+        '''
+        container for background tasks with latest-wins semantics per key
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # callbacks may submit new tasks, so the lock must be reentrant
+        self.lock = threading.RLock()
+
+        self.generations = dict()
+        self.futures = dict()
+
+
+    def submit(self, key, fn, callback=None, errback=None):
+        '''
+        run fn in the background and pass its result to callback, superseding older tasks for key
+        '''
+        with self.lock:
+            self._cancel(key)
+
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+
+            future = self.executor.submit(fn)
+            self.futures[key] = future
+
+        future.add_done_callback(
+            lambda f: self._done(key, generation, f, callback, errback)
+        )
+
+        return future
+
+
+    def cancel(self, key):
+        '''
+        cancel a pending task for key and discard its result if it is already running
+        '''
+        with self.lock:
+            self._cancel(key)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+
+    def is_busy(self, key):
+        '''
+        check if a task for key is pending
+        '''
+        with self.lock:
+            return key in self.futures
+
+
+    def _cancel(self, key):
+        '''
+        cancel the future for key if it has not started yet
+        '''
+        future = self.futures.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+
+    def _done(self, key, generation, future, callback, errback):
+        '''
+        deliver a result only if no newer task was submitted for the same key
+        '''
+        if future.cancelled():
+            return
+
+        with self.lock:
+            if self.generations.get(key) != generation:
+                return
+
+            self.futures.pop(key, None)
+
+            exc = future.exception()
+            if exc is not None:
+                if errback is not None:
+                    errback(exc)
+                else:
+                    traceback.print_exception(type(exc), exc, exc.__traceback__)
+            elif callback is not None:
+                callback(future.result())
+
+
+class Debouncer:
+    def __init__(self, fn, wait=DEBOUNCE_WAIT):
+        '''
+        container that calls fn once a burst of calls has been quiet for wait seconds
+        '''
+        self.fn = fn
+        self.wait = wait
+
+        self.lock = threading.Lock()
+        self.timer = None
+
+
+    def __call__(self, *args, **kwargs):
+        '''
+        restart the wait, only the last call of a burst goes through
+        '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+
+            self.timer = threading.Timer(self.wait, self.fn, args=args, kwargs=kwargs)
+            self.timer.daemon = True
+            self.timer.start()
+
+
+    def cancel(self):
+        '''
+        drop a pending call
+        '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+# shared task runner for all widget callbacks
+TASKS = TaskRunner()
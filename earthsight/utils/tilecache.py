@@ -0,0 +1,153 @@
+'''
+tilecache.py
+
+Class definition for TileCache, which persists map tiles in an MBTiles-style SQLite file
+'''
+
+
+import os
+import sqlite3
+import threading
+import time
+
+from earthsight.utils.diskcache import CACHE_DIR
+from earthsight.utils.http import HTTP_POOL
+from earthsight.utils.singleflight import SingleFlight
+from earthsight.utils.sqlitecache import SQLiteCache
+
+
+# largest total size of cached tiles in bytes
+TILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# when the cache is full, evict least recently used tiles down to this fraction of the limit
+TILE_CACHE_LOW_WATER = 0.9
+
+
+class TileCache(SQLiteCache):
+    table = 'tiles'
+    key_columns = ('layer', 'zoom_level', 'tile_column', 'tile_row')
+
+    def __init__(self, path, max_bytes):
+        '''
+        container for tiles keyed by an image/viz hash plus z/x/y, evicted by total size
+
+        tiles are stored with MBTiles column names, rows follow the TMS scheme used by MBTiles
+        '''
+        super().__init__(path, max_bytes)
+
+        # running total of stored bytes, read from the file once
+        self.total = None
+        self.lock = threading.Lock()
+
+        # the browser and the prefetcher often miss the same tile at once, only one goes upstream
+        self.in_flight = SingleFlight()
+
+
+    def _create(self, conn):
+        '''
+        create the MBTiles tables if needed
+        '''
+        conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS tiles ('
+            'layer TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, '
+            'tile_data BLOB, size INTEGER, accessed REAL, '
+            'PRIMARY KEY (layer, zoom_level, tile_column, tile_row))'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)')
+        conn.execute("INSERT OR IGNORE INTO metadata VALUES ('format', 'png')")
+
+
+    def get(self, key, z, x, y):
+        '''
+        get tile bytes, or None if the tile is not cached
+        '''
+        row = (1 << z) - 1 - y
+        try:
+            conn = self._connect()
+            result = conn.execute(
+                'SELECT tile_data FROM tiles '
+                'WHERE layer = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (key, z, x, row)
+            ).fetchone()
+            if result is None:
+                return None
+
+            self._touch(conn, (key, z, x, row))
+        except sqlite3.Error:
+            # the cache is best effort, an unusable cache file behaves like a miss
+            return None
+
+        return bytes(result[0])
+
+
+    def put(self, key, z, x, y, tile):
+        '''
+        store tile bytes, then evict least recently used tiles if over the size limit
+        '''
+        row = (1 << z) - 1 - y
+        try:
+            conn = self._connect()
+
+            # another kernel may have stored the same tile already, its size is replaced, not added to
+            replaced = conn.execute(
+                'SELECT size FROM tiles '
+                'WHERE layer = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (key, z, x, row)
+            ).fetchone()
+            replaced = 0 if replaced is None else replaced[0]
+
+            conn.execute(
+                'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, z, x, row, sqlite3.Binary(tile), len(tile), time.time())
+            )
+            conn.commit()
+
+            with self.lock:
+                if self.total is None:
+                    self.total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+                else:
+                    self.total += len(tile) - replaced
+
+                if self.total > self.max_bytes:
+                    self._evict(conn)
+        except sqlite3.Error:
+            pass
+
+
+    def _evict(self, conn):
+        '''
+        drop least recently used tiles until under the low water mark
+        '''
+        # other processes share the file, so start from its actual size
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+
+        self.total = self._evict_lru(conn, total, self.max_bytes * TILE_CACHE_LOW_WATER)
+
+
+    def fetch(self, key, url, z, x, y):
+        '''
+        get a tile from the cache, or from an upstream XYZ URL template on a miss, None if upstream has no tile
+        '''
+        tile = self.get(key, z, x, y)
+        if tile is None:
+            tile = self.in_flight.do((key, z, x, y), lambda: self._fetch_upstream(key, url, z, x, y))
+
+        return tile
+
+
+    def _fetch_upstream(self, key, url, z, x, y):
+        '''
+        get a tile from an upstream XYZ URL template and store it, None if upstream has no tile
+        '''
+        status, _, body = HTTP_POOL.get(url.format(z=z, x=x, y=y))
+        if status != 200:
+            return None
+
+        self.put(key, z, x, y, body)
+
+        return body
+
+
+# shared tile cache for all kernels on this host
+TILE_CACHE = TileCache(os.path.join(CACHE_DIR, 'tiles.mbtiles'), TILE_CACHE_MAX_BYTES)
@@ -0,0 +1,179 @@
+'''
+tiles.py
+
+Python utilities for working with web mercator XYZ tiles and quadkeys
+'''
+
+
+import math
+
+
+# tile size in pixels for leaflet maps
+TILE_SIZE = 256
+
+# web mercator cannot represent latitudes beyond this
+MAX_LAT = 85.0511287798
+
+# half the circumference of the earth in web mercator meters
+ORIGIN_SHIFT = 20037508.342789244
+
+# meters per degree at the equator, which GEE uses to turn a scale into degrees in EPSG:4326
+METERS_PER_DEGREE = 2 * ORIGIN_SHIFT / 360.0
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    '''
+    get the x, y index of the tile containing a coordinate at a zoom level
+    '''
+    n = 2 ** zoom
+    lat = min(max(lat, -MAX_LAT), MAX_LAT)
+    lat_rad = math.radians(lat)
+
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+
+    x = min(max(x, 0), n - 1)
+    y = min(max(y, 0), n - 1)
+
+    return x, y
+
+
+def tile_to_bounds(x, y, zoom):
+    '''
+    get leaflet bounds ((south, west), (north, east)) of a tile
+    '''
+    n = 2 ** zoom
+
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+
+    return ((south, west), (north, east))
+
+
+def bounds_to_pixels(bounds, scale):
+    '''
+    get the number of EPSG:4326 pixels, the projection composites are reduced in, covering leaflet
+    bounds at a scale in meters
+    '''
+    (south, west), (north, east) = bounds
+    size = scale / METERS_PER_DEGREE
+
+    return abs(east - west) / size * abs(north - south) / size
+
+
+def tile_to_quadkey(x, y, zoom):
+    '''
+    get the quadkey of a tile, which names a tile and all its ancestors in a single string
+    '''
+    digits = list()
+    for z in range(zoom, 0, -1):
+        digit = 0
+        mask = 1 << (z - 1)
+        if x & mask:
+            digit += 1
+        if y & mask:
+            digit += 2
+        digits.append(str(digit))
+
+    return ''.join(digits)
+
+
+def quadkey_to_tile(quadkey):
+    '''
+    get x, y and zoom of a tile from its quadkey
+    '''
+    x = 0
+    y = 0
+    zoom = len(quadkey)
+    for z, digit in zip(range(zoom, 0, -1), quadkey):
+        mask = 1 << (z - 1)
+        digit = int(digit)
+        if digit & 1:
+            x |= mask
+        if digit & 2:
+            y |= mask
+
+    return x, y, zoom
+
+
+def tiles_in_bounds(bounds, zoom):
+    '''
+    get x, y indices of all tiles at a zoom level that intersect leaflet bounds
+    '''
+    min_lat, min_lon = bounds[0]
+    max_lat, max_lon = bounds[1]
+
+    min_x, min_y = lonlat_to_tile(min_lon, max_lat, zoom)
+    max_x, max_y = lonlat_to_tile(max_lon, min_lat, zoom)
+
+    tiles = [(x, y) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1)]
+
+    return tiles
+
+
+def lonlat_to_meters(lon, lat):
+    '''
+    get web mercator (EPSG:3857) x, y in meters of a coordinate
+    '''
+    lat = min(max(lat, -MAX_LAT), MAX_LAT)
+
+    x = lon * ORIGIN_SHIFT / 180.0
+    y = math.log(math.tan((90.0 + lat) * math.pi / 360.0)) * ORIGIN_SHIFT / math.pi
+
+    return x, y
+
+
+def meters_to_lonlat(x, y):
+    '''
+    get lon, lat of web mercator (EPSG:3857) x, y in meters
+    '''
+    y = min(max(y, -ORIGIN_SHIFT), ORIGIN_SHIFT)
+
+    lon = x / ORIGIN_SHIFT * 180.0
+    lat = math.degrees(2 * math.atan(math.exp(y / ORIGIN_SHIFT * math.pi)) - math.pi / 2)
+
+    return lon, lat
+
+
+def center_to_bounds(center, zoom, size):
+    '''
+    get leaflet bounds of a map view of (width, height) pixels around a (lat, lon) center
+    '''
+    lat, lon = center
+    x, y = lonlat_to_meters(lon, lat)
+
+    resolution = 2 * ORIGIN_SHIFT / (TILE_SIZE * 2 ** zoom)
+    half_width = size[0] / 2 * resolution
+    half_height = size[1] / 2 * resolution
+
+    min_lon, min_lat = meters_to_lonlat(max(x - half_width, -ORIGIN_SHIFT), y - half_height)
+    max_lon, max_lat = meters_to_lonlat(min(x + half_width, ORIGIN_SHIFT), y + half_height)
+
+    return ((min_lat, min_lon), (max_lat, max_lon))
+
+
+def bounds_to_meters(bounds):
+    '''
+    get web mercator (min_x, min_y, max_x, max_y) in meters of leaflet bounds
+    '''
+    min_lat, min_lon = bounds[0]
+    max_lat, max_lon = bounds[1]
+
+    min_x, min_y = lonlat_to_meters(min_lon, min_lat)
+    max_x, max_y = lonlat_to_meters(max_lon, max_lat)
+
+    return (min_x, min_y, max_x, max_y)
+
+
+def tile_to_meters(x, y, zoom):
+    '''
+    get web mercator (min_x, min_y, max_x, max_y) in meters of a tile
+    '''
+    size = 2 * ORIGIN_SHIFT / 2 ** zoom
+
+    min_x = -ORIGIN_SHIFT + x * size
+    max_y = ORIGIN_SHIFT - y * size
+
+    return (min_x, max_y - size, min_x + size, max_y)
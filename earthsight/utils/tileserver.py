@@ -0,0 +1,297 @@
+'''
+tileserver.py
+
+Class definition for TileServer, which renders XYZ tiles from NumPy arrays in this process and serves them to the map,
+and proxies remote tiles through a persistent cache
+'''
+
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import re
+import threading
+from urllib.parse import urlsplit
+
+from earthsight.utils.cache import LRUCache
+from earthsight.utils.singleflight import SingleFlight
+from earthsight.utils.tilecache import TILE_CACHE
+
+
+# serve tiles to a browser on the same host
+TILE_SERVER_HOST = '127.0.0.1'
+
+# base URL the browser reaches the tile server at, set EARTHSIGHT_TILE_URL when the browser is on
+# another host, e.g. '/proxy/{port}' behind jupyter-server-proxy
+TILE_SERVER_URL = os.environ.get('EARTHSIGHT_TILE_URL', 'http://{host}:{port}')
+
+# number of tiles rendered concurrently, leaflet requests many tiles at once
+TILE_SERVER_WORKERS = 8
+
+# number of rendered PNG tiles kept in memory
+TILE_RENDER_CACHE_SIZE = 2048
+
+# tile requests look like /tiles/<source id>/<z>/<x>/<y>.png
+TILE_PATH = re.compile(r'^/tiles/(\w+)/(\d+)/(\d+)/(\d+)\.png')
+
+# proxied tile requests look like /proxy/<tile key>/<z>/<x>/<y>
+PROXY_PATH = re.compile(r'^/proxy/(\w+)/(\d+)/(\d+)/(\d+)')
+
+
+class TileServer:
+    def __init__(self,
+                 host=TILE_SERVER_HOST,
+                 port=0,
+                 workers=TILE_SERVER_WORKERS,
+                 tile_cache=TILE_CACHE,
+                 base_url=TILE_SERVER_URL):
+        '''
+        container for a background HTTP server that renders tiles from registered sources
+
+        a source provides bands, viz_params, stage_keys and read_tile(z, x, y, band_names), which
+        returns raw band arrays and a valid mask, the server applies the stretch and encodes PNGs
+
+        remote XYZ URLs can also be registered under a stable key, their tiles are served from
+        the tile cache and only fetched upstream on a miss
+        '''
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.base_url = base_url
+
+        self.sources = dict()
+        self.render_cache = LRUCache(TILE_RENDER_CACHE_SIZE)
+
+        # the browser and the prefetcher often miss the same tile at once, only one renders it
+        self.in_flight = SingleFlight()
+
+        self.proxies = dict()
+        self.tile_cache = tile_cache
+
+        self.httpd = None
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        '''
+        start serving in a background thread, picking a free port unless one was given
+        '''
+        with self.lock:
+            if self.httpd is not None:
+                return
+
+            self.httpd = PooledHTTPServer((self.host, self.port), TileHandler, self.workers)
+            self.httpd.tile_server = self
+            self.port = self.httpd.server_address[1]
+
+            thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+            thread.start()
+
+
+    def register(self, source):
+        '''
+        register a source that renders tiles, returns a tile URL for its current state
+        '''
+        self.start()
+
+        source_id = 'src{}'.format(id(source))
+        self.sources[source_id] = source
+
+        # tile URLs change with the source state, so leaflet fetches fresh tiles after an update
+        url = '{}/tiles/{}/{{z}}/{{x}}/{{y}}.png?v={}'.format(
+            self.get_base_url(),
+            source_id,
+            self.get_version(source)
+        )
+
+        return url
+
+
+    def register_proxy(self, key, url):
+        '''
+        register an upstream XYZ URL template under a key, returns a URL serving its tiles through the cache
+        '''
+        self.start()
+
+        # the upstream URL may change for the same key, e.g. when a map ID expires
+        self.proxies[key] = url
+
+        return '{}/proxy/{}/{{z}}/{{x}}/{{y}}'.format(self.get_base_url(), key)
+
+
+    def get_base_url(self):
+        '''
+        get the base URL the browser reaches this server at
+        '''
+        return self.base_url.format(host=self.host, port=self.port).rstrip('/')
+
+
+    def get_path_tile(self, path):
+        '''
+        get the tile at a request path, or None if no tile is served there
+        '''
+        match = TILE_PATH.match(path)
+        get_tile = self.get_tile
+        if match is None:
+            match = PROXY_PATH.match(path)
+            get_tile = self.get_proxy_tile
+
+        if match is None:
+            return None
+
+        key = match.group(1)
+        z, x, y = [int(v) for v in match.groups()[1:]]
+
+        return get_tile(key, z, x, y)
+
+
+    def serves(self, url):
+        '''
+        check if a tile URL template is served here, rather than straight from upstream
+        '''
+        return url.startswith(self.get_base_url() + '/')
+
+
+    def prefetch_tile(self, url, z, x, y):
+        '''
+        warm the caches behind a tile URL template, returns False if the URL is not served here
+        '''
+        if not self.serves(url):
+            return False
+
+        tile_url = url.format(z=z, x=x, y=y)
+        self.get_path_tile(urlsplit(tile_url[len(self.get_base_url()):]).path)
+
+        return True
+
+
+    def get_version(self, source):
+        '''
+        get a hash of everything a source's tiles depend on
+        '''
+        return hashlib.sha1(repr(sorted(source.stage_keys.items())).encode('utf-8')).hexdigest()
+
+
+    def get_tile(self, source_id, z, x, y):
+        '''
+        get a PNG tile from a registered source, or None if the source is unknown
+        '''
+        source = self.sources.get(source_id)
+        if source is None:
+            return None
+
+        # key by the state the tile is rendered with, which may be newer than the requested URL
+        key = (source_id, self.get_version(source), z, x, y)
+        png = self.render_cache.get(key)
+        if png is None:
+            png = self.in_flight.do(key, lambda: self._render_and_cache(key, source, z, x, y))
+
+        return png
+
+
+    def _render_and_cache(self, key, source, z, x, y):
+        '''
+        render a tile and keep it in the render cache
+        '''
+        png = self.render_tile(source, z, x, y)
+        self.render_cache.set(key, png)
+
+        return png
+
+
+    def render_tile(self, source, z, x, y):
+        '''
+        render a PNG tile of a source's active bands stretched to their viz ranges
+        '''
+        # numpy and PIL are slow to import, so they are only loaded once a tile is rendered locally
+        from earthsight.utils.render import render_png
+
+        viz_params = source.viz_params
+        band_names = viz_params['bands']
+
+        data, valid = source.read_tile(z, x, y, band_names)
+
+        ranges = list()
+        for band_name in band_names:
+            band = source.bands.get(band_name)
+            ranges.append((band.get_min(), band.get_max()))
+
+        return render_png(data, valid, viz_params, ranges)
+
+
+    def get_proxy_tile(self, key, z, x, y):
+        '''
+        get a proxied tile from the cache or upstream, or None if there is no such tile
+        '''
+        url = self.proxies.get(key)
+        if url is None:
+            # tiles cached by an earlier session can still be served
+            return self.tile_cache.get(key, z, x, y)
+
+        return self.tile_cache.fetch(key, url, z, x, y)
+
+
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, server_address, handler, workers):
+        '''
+        HTTP server that handles requests on a bounded thread pool
+        '''
+        super().__init__(server_address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+
+    def process_request(self, request, client_address):
+        '''
+        handle each connection on the pool instead of the serving thread
+        '''
+        self.executor.submit(self._process_request, request, client_address)
+
+
+    def _process_request(self, request, client_address):
+        '''
+        handle a connection and close it, mirroring socketserver.ThreadingMixIn
+        '''
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        '''
+        respond to a tile request
+        '''
+        try:
+            tile = self.server.tile_server.get_path_tile(self.path)
+        except Exception as exc:
+            self.send_error(500, str(exc))
+            return
+
+        if tile is None:
+            self.send_error(404)
+            return
+
+        # upstream tiles are PNG unless a JPEG format was requested
+        content_type = 'image/png' if tile.startswith(b'\x89PNG') else 'image/jpeg'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(tile)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(tile)
+
+
+    def log_message(self, format, *args):
+        '''
+        keep tile requests out of the notebook output
+        '''
+        pass
+
+
+# shared tile server for all local sources and proxied remote tiles
+TILE_SERVER = TileServer()
@@ -0,0 +1,91 @@
+'''
+timing.py
+
+Class definition for Timings, which records how long startup milestones take
+'''
+
+
+import json
+import os
+import threading
+import time
+
+
+# when set, e.g. by the managed server, each process writes its startup milestones here
+TIMING_DIR = os.environ.get('EARTHSIGHT_TIMING_DIR')
+
+
+class Timings:
+    def __init__(self, path=None):
+        '''
+        container for named milestones, timed from when this object was created, optionally
+        saved to a JSON file as they are reached
+        '''
+        self.start = time.perf_counter()
+        self.path = path
+
+        self.marks = list()
+        self.events = dict()
+        self.lock = threading.Lock()
+
+
+    def mark(self, name):
+        '''
+        record a milestone, only the first time it is reached counts
+        '''
+        with self.lock:
+            event = self.events.setdefault(name, threading.Event())
+            if event.is_set():
+                return
+
+            self.marks.append((name, time.perf_counter() - self.start))
+            event.set()
+
+            if self.path is not None:
+                self.save()
+
+
+    def wait(self, name, timeout=None):
+        '''
+        wait for a milestone, returns False if it was not reached in time
+        '''
+        with self.lock:
+            event = self.events.setdefault(name, threading.Event())
+
+        return event.wait(timeout)
+
+
+    def get_marks(self):
+        '''
+        get milestones as a list of dicts with their time since start in ms
+        '''
+        return [{'milestone': name, 'ms': round(elapsed * 1000)} for name, elapsed in self.marks]
+
+
+    def save(self):
+        '''
+        write milestones to the JSON file, timings are best effort so failures are ignored
+        '''
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'marks': self.get_marks()}, f)
+        except OSError:
+            pass
+
+
+    def report(self):
+        '''
+        get a table of milestones with their time since start and since the previous milestone
+        '''
+        lines = ['{:<24}{:>10}{:>10}'.format('milestone', 'total ms', 'step ms')]
+
+        last = 0
+        for name, elapsed in self.marks:
+            lines.append('{:<24}{:>10.0f}{:>10.0f}'.format(name, elapsed * 1000, (elapsed - last) * 1000))
+            last = elapsed
+
+        return '\n'.join(lines)
+
+
+# milestones from the first earthsight import to the first layer on the map
+STARTUP = Timings(os.path.join(TIMING_DIR, '{}.json'.format(os.getpid())) if TIMING_DIR else None)
@@ -24,11 +24,12 @@ setup(
         'pandas==1.1.3',
         'Pillow==8.0.1',
         'Shapely==1.7.1',
-        'voila==0.2.4'
+        'voila==0.3.0'
     ],
     entry_points={
         'console_scripts': [
-            'es = earthsight.run.run:main'
+            'es = earthsight.run.run:main',
+            'es-cache = earthsight.utils.cacheserver:main'
         ]
     }
 )